@@ -1,23 +1,29 @@
 # maintenance_alert_refactored.py
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta, date
 import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.image import MIMEImage
-from email.mime.base import MIMEBase
-from email import encoders
+from email.message import EmailMessage
 from pathlib import Path
 import sys
+import os
 import json
+import gzip
+import hashlib
 import shutil
-import matplotlib
-matplotlib.use('Agg')  # Use non-GUI backend for thread safety
-import matplotlib.pyplot as plt
+import threading
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from openpyxl import load_workbook
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 from typing import Dict, List, Tuple, Optional, Any, NamedTuple
 
+try:
+    import orjson  # Быстрый разбор/сериализация JSON (необязательно)
+except ImportError:
+    orjson = None
+
 # --- 1. Конфигурация и константы ---
 class Config:
     """Класс для хранения всех конфигурационных данных."""
@@ -29,14 +35,18 @@ class Config:
     TMP_DIR = PROGRAM_DIR / "tmp"
     BACKUP_DIR = PROGRAM_DIR / "backups_excel"
     LOG_FILE = DATA_DIR / "maintenance_alert.log"
+    TEMPLATES_DIR = PROGRAM_DIR / "templates"
+    JINJA_CACHE_DIR = TMP_DIR / "jinja_cache"  # Скомпилированные шаблоны (байткод Jinja)
 
     EXCEL_FILENAME = "Обслуживание ПК и шкафов АСУТП.xlsx"
-    HISTORY_FILE = DATA_DIR / "maintenance_alert_history.json"
+    HISTORY_FILE = DATA_DIR / "maintenance_alert_history.json.gz"
+    LEGACY_HISTORY_FILE = DATA_DIR / "maintenance_alert_history.json"  # Несжатый формат прежних версий
     SERVICED_HISTORY_FILE = DATA_DIR / "serviced_history.json"
     EXCEL_SNAPSHOT_FILE = DATA_DIR / "excel_snapshot.json"
 
     SMTP_SERVER = "mgd-ex1.pavlik-gold.ru"
     SMTP_PORT = 25
+    SMTP_TIMEOUT = 30  # секунд на подключение и каждую операцию с сервером
     SENDER_EMAIL = "maintenance.asutp@pavlik-gold.ru"
     RECIPIENTS = [
         "asutp@pavlik-gold.ru",
@@ -61,6 +71,17 @@ class Config:
     CHART_DAYS = 62  # Количество дней отображаемых в диаграмме
     HISTORY_MAX_DAYS = 180  # Глубина хранения истории обслуживания (6 месяцев ≈ 180 дней)
 
+    @classmethod
+    def get_jinja_bytecode_cache(cls, name: str) -> FileSystemBytecodeCache:
+        """Возвращает дисковый кэш байткода шаблонов: компиляция не повторяется между запусками.
+
+        У каждого окружения Jinja (письмо, web-панель) свой каталог: байткод зависит
+        от настроек окружения (например, autoescape).
+        """
+        cache_dir = cls.JINJA_CACHE_DIR / name
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        return FileSystemBytecodeCache(str(cache_dir))
+
     @classmethod
     def get_excel_file_path(cls) -> Path:
         """Ищет Excel-файл сначала в папке скрипта, затем уровнем выше."""
@@ -114,6 +135,14 @@ class ExcelHandler:
         self.config = config
         self.logger = logger
         self.xlwings_available = self._check_xlwings()
+        self.calamine_available = self._check_calamine()
+        # Категориальные типы: сравнения и фильтры идут по int8-кодам, а не по строкам
+        self.status_dtype = pd.CategoricalDtype(self.config.MAINTENANCE_STATUSES)
+        self.type_dtype = pd.CategoricalDtype(list(self.config.SHEETS_CONFIG))
+        # Последний прочитанный файл: ((путь, mtime_ns, размер), {лист: DataFrame})
+        self._sheets_cache: Optional[Tuple[Tuple[str, int, int], Dict[str, pd.DataFrame]]] = None
+        # Результат read_data для того же ключа файла: (ключ, (срочные, внимание, всего, счетчики))
+        self._data_cache: Optional[Tuple[Tuple[str, int, int], Tuple[pd.DataFrame, pd.DataFrame, int, Dict[str, int]]]] = None
 
     def _check_xlwings(self) -> bool:
         """Проверяет доступность xlwings."""
@@ -126,6 +155,60 @@ class ExcelHandler:
             self.logger.log("💡 Установите: pip install xlwings")
             return False
 
+    def _check_calamine(self) -> bool:
+        """Проверяет доступность python-calamine (быстрое чтение xlsx на Rust)."""
+        try:
+            from python_calamine import CalamineWorkbook
+            self.CalamineWorkbook = CalamineWorkbook
+            return True
+        except ImportError:
+            self.logger.log("💡 Для ускорения чтения Excel установите: pip install python-calamine")
+            return False
+
+    @staticmethod
+    def _convert_cell(value):
+        """Приводит значение ячейки calamine/openpyxl к виду, который дает pandas.read_excel."""
+        if isinstance(value, str):
+            return value if value != "" else None
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        if type(value) is date:
+            return datetime(value.year, value.month, value.day)
+        return value
+
+    def _open_workbook(self, file_path: Path):
+        """Открывает книгу один раз для чтения нескольких листов (контекстный менеджер)."""
+        if self.calamine_available:
+            return self.CalamineWorkbook.from_path(str(file_path))
+        # Потоковый режим openpyxl: строки разбираются по мере чтения, закрытие через closing()
+        # keep_links=False: внешние ссылки книги для чтения значений не нужны
+        return closing(load_workbook(file_path, read_only=True, data_only=True, keep_links=False))
+
+    def _iter_sheet_rows(self, workbook, sheet_name: str):
+        """Возвращает сырые строки данных листа: с 5-й по 504-ю (строка 4 - заголовки)."""
+        if self.calamine_available:
+            return workbook.get_sheet_by_name(sheet_name).to_python(skip_empty_area=False)[4:504]
+        return workbook[sheet_name].iter_rows(min_row=5, max_row=504, max_col=len(self.config.COLUMN_NAMES),
+                                              values_only=True)
+
+    def _read_sheet(self, workbook, sheet_name: str) -> pd.DataFrame:
+        """Читает лист с оборудованием из открытой книги: колонки COLUMN_NAMES, без пустых строк.
+
+        Колонка 'Статус' сразу приводится к категориальному типу self.status_dtype.
+        """
+        column_count = len(self.config.COLUMN_NAMES)
+        # Пустые строки отбрасываются сразу при разборе, без отдельного прохода dropna
+        # (пропускаются, а не обрывают чтение: в середине графика бывают пустые строки)
+        rows = []
+        for raw_row in self._iter_sheet_rows(workbook, sheet_name):
+            row = [self._convert_cell(value) for value in raw_row[:column_count]]
+            if any(value is not None for value in row):
+                row.extend([None] * (column_count - len(row)))
+                rows.append(row)
+        df = pd.DataFrame(rows, columns=self.config.COLUMN_NAMES)
+        df['Статус'] = df['Статус'].astype(self.status_dtype)
+        return df
+
     def _verify_file_write(self, file_path: Path, original_mtime: float = None) -> bool:
         """Проверяет, что файл был успешно сохранен и обновлен."""
         try:
@@ -145,6 +228,18 @@ class ExcelHandler:
             self.logger.log(f"❌ Ошибка проверки файла: {e}")
             return False
 
+    def _is_recalculated_copy_fresh(self, file_path: Path, tmp_file_path: Path) -> bool:
+        """Проверяет, что копия с пересчитанными формулами сделана сегодня и позже изменения исходника.
+
+        Формулы статусов зависят от текущей даты, поэтому пересчет годен только в день его выполнения.
+        """
+        try:
+            tmp_stat = tmp_file_path.stat()
+        except OSError:
+            return False
+        return (tmp_stat.st_mtime_ns >= file_path.stat().st_mtime_ns
+                and datetime.fromtimestamp(tmp_stat.st_mtime).date() == datetime.now().date())
+
     def recalculate_formulas(self, file_path: Path) -> Tuple[bool, Optional[Path]]:
         """Пересчитывает формулы в Excel файле."""
         if not self.xlwings_available:
@@ -156,6 +251,11 @@ class ExcelHandler:
         self.config.TMP_DIR.mkdir(parents=True, exist_ok=True)
         tmp_file_path = self.config.TMP_DIR / file_path.name
 
+        # Один stat() вместо запуска Excel через COM, если исходный файл не менялся
+        if self._is_recalculated_copy_fresh(file_path, tmp_file_path):
+            self.logger.log(f"✅ Файл не изменялся с последнего пересчета, используем {tmp_file_path}")
+            return True, tmp_file_path
+
         try:
             self.logger.log(f"🔄 Пересчитываем формулы с xlwings: {file_path}")
             original_mtime = file_path.stat().st_mtime
@@ -186,11 +286,11 @@ class ExcelHandler:
             self.logger.log("💡 Совет: убедитесь, что файл Excel не открыт в другом приложении")
             return False, None
 
-    def generate_maintenance_data_file(self, urgent_items: List[pd.DataFrame]) -> Optional[Path]:
+    def generate_maintenance_data_file(self, urgent_items: pd.DataFrame) -> Optional[Path]:
         """
         Создает файл maintenance_data.xlsx на основе шаблона с данными для обслуживания.
         Args:
-            urgent_items: Список DataFrame с элементами требующими обслуживания
+            urgent_items: DataFrame с элементами требующими обслуживания (колонка 'Тип' - лист)
         Returns:
             Путь к созданному файлу или None при ошибке
         """
@@ -216,6 +316,9 @@ class ExcelHandler:
             export_columns = ["№", "Объект", "Наименование", "Обозначение", "Место расположения", 
             "Работы", "Интервал ТО (дней)", "Напоминание (за дней)", "Дата последнего ТО", "Дата следующего ТО", "Статус" ]
             
+            # Записи разбиваются по листам одной группировкой по категориальной колонке 'Тип'
+            sheet_frames = dict(list(urgent_items.groupby('Тип', observed=True)))
+
             # Обрабатываем каждый лист
             for sheet_name in self.config.SHEETS_CONFIG.keys():
                 if sheet_name in wb.sheetnames:
@@ -226,20 +329,18 @@ class ExcelHandler:
                     self.logger.log(f"📅 Записана дата {current_date} в ячейку D1 листа '{sheet_name}'")
                     
                     # Находим данные для этого листа
-                    sheet_data = None
-                    for df in urgent_items:
-                        if 'Тип' in df.columns and df['Тип'].iloc[0] == sheet_name:
-                            sheet_data = df
-                            break
+                    sheet_data = sheet_frames.get(sheet_name, urgent_items.iloc[:0])
                     
-                    if sheet_data is not None and not sheet_data.empty:
+                    if not sheet_data.empty:
                         self.logger.log(f"📝 Записываем {len(sheet_data)} записей на лист '{sheet_name}'")
                         ws['D2'] = len(sheet_data)
 
                         # Записываем данные начиная с 5й строки
                         start_row = 5
                         record_number = 1  # Нумерация записей начинается с 1
-                        for idx, (_, row) in enumerate(sheet_data.iterrows()):
+                        # Позиции колонок вычисляются один раз; строки читаются кортежами без создания Series
+                        column_positions = {name: pos for pos, name in enumerate(sheet_data.columns)}
+                        for idx, row in enumerate(sheet_data.itertuples(index=False, name=None)):
                             current_row = start_row + idx
                             
                             # Записываем данные в соответствующие столбцы
@@ -247,8 +348,8 @@ class ExcelHandler:
                                 if col_name == "№":
                                     # Для колонки "№" используем последовательную нумерацию
                                     value = str(record_number)
-                                elif col_name in row:
-                                    value = row[col_name]
+                                elif col_name in column_positions:
+                                    value = row[column_positions[col_name]]
                                     # Преобразуем в скаляр
                                     if hasattr(value, 'item'):
                                         value = value.item()
@@ -287,8 +388,50 @@ class ExcelHandler:
             self.logger.log(f"❌ Ошибка при создании файла maintenance_data.xlsx: {e}")
             return None
 
-    def read_data(self) -> Tuple[List[pd.DataFrame], List[pd.DataFrame], int, Dict[str, int], bool]:
-        """Читает данные из Excel файла."""
+    @staticmethod
+    def _file_cache_key(file_path: Path) -> Optional[Tuple[str, int, int]]:
+        """Ключ кэша прочитанного файла: (путь, mtime_ns, размер) или None, если файл недоступен."""
+        try:
+            stat = Path(file_path).stat()
+        except OSError:
+            return None
+        return (str(file_path), stat.st_mtime_ns, stat.st_size)
+
+    def read_sheets(self, file_path: Path) -> Dict[str, pd.DataFrame]:
+        """Читает все листы оборудования за одно открытие книги.
+
+        Возвращает {имя листа: DataFrame с колонками COLUMN_NAMES}; лист, который не удалось
+        прочитать, пропускается с записью в лог.
+        """
+        # Повторные чтения неизмененного файла (read_data, снимок, данные оборудования
+        # в одном запуске; запросы web-панели) берутся из кэша
+        cache_key = self._file_cache_key(file_path)
+        if cache_key is not None and self._sheets_cache is not None and self._sheets_cache[0] == cache_key:
+            return dict(self._sheets_cache[1])
+
+        sheets = {}
+        # Книга открывается один раз: ZIP, sharedStrings и стили разбираются однократно для всех листов
+        try:
+            with self._open_workbook(file_path) as workbook:
+                for sheet_name in self.config.SHEETS_CONFIG:
+                    try:
+                        sheets[sheet_name] = self._read_sheet(workbook, sheet_name)
+                    except Exception as e:
+                        self.logger.log(f"Ошибка при чтении листа {sheet_name}: {e}")
+        except Exception as e:
+            self.logger.log(f"Ошибка при открытии файла {file_path}: {e}")
+            return sheets
+
+        if cache_key is not None and len(sheets) == len(self.config.SHEETS_CONFIG):
+            self._sheets_cache = (cache_key, sheets)
+        return dict(sheets)
+
+    def read_data(self) -> Tuple[pd.DataFrame, pd.DataFrame, int, Dict[str, int], bool]:
+        """Читает данные из Excel файла.
+
+        Срочные и требующие внимания элементы всех листов возвращаются одним DataFrame
+        на статус; лист, с которого взята запись, указан в колонке 'Тип'.
+        """
         recalc_success, excel_file_to_use = self.recalculate_formulas(self.config.get_excel_file_path())
 
         if excel_file_to_use is None:
@@ -296,44 +439,49 @@ class ExcelHandler:
             self.logger.log(f"⚠️ Используем оригинальный файл: {excel_file_to_use}")
         else:
             self.logger.log(f"✅ Используем файл с пересчитанными формулами: {excel_file_to_use}")
+        self.last_excel_file_path = excel_file_to_use
+
+        # Файл не менялся с прошлого чтения (повторные запросы web-панели) - выборки уже готовы
+        cache_key = self._file_cache_key(excel_file_to_use)
+        if cache_key is not None and self._data_cache is not None and self._data_cache[0] == cache_key:
+            urgent_items, warning_items, total_records, status_counts = self._data_cache[1]
+            self.logger.log("📋 Файл не изменялся с прошлого чтения, используем прочитанные данные")
+            return urgent_items, warning_items, total_records, dict(status_counts), recalc_success
 
-        urgent_items = []
-        warning_items = []
+        urgent_frames = []
+        warning_frames = []
+        frames_by_status = {self.config.STATUS_URGENT: urgent_frames, self.config.STATUS_WARNING: warning_frames}
         total_records = 0
         status_counts = {status: 0 for status in self.config.MAINTENANCE_STATUSES}
 
-        for sheet_name, config in self.config.SHEETS_CONFIG.items():
-            try:
-                self.logger.log(f"Читаем лист: {sheet_name}")
-                df = pd.read_excel(excel_file_to_use, sheet_name=sheet_name, header=3, nrows=500)
-
-                if len(df.columns) > len(self.config.COLUMN_NAMES):
-                    df = df.iloc[:, :len(self.config.COLUMN_NAMES)]
-                df.columns = self.config.COLUMN_NAMES
-                df = df.dropna(how='all')
-
-                total_records += len(df)
-                for status in status_counts.keys():
-                    status_counts[status] += len(df[df['Статус'] == status])
-
-                urgent_df = df[df['Статус'] == self.config.STATUS_URGENT]
-                warning_df = df[df['Статус'] == self.config.STATUS_WARNING]
-
-                self.logger.log(f"  Найдено {self.config.STATUS_URGENT}: {len(urgent_df)}, {self.config.STATUS_WARNING}: {len(warning_df)}")
-
-                if not urgent_df.empty:
-                    urgent_df = urgent_df.copy()
-                    urgent_df['Тип'] = sheet_name
-                    urgent_items.append(urgent_df)
-                if not warning_df.empty:
-                    warning_df = warning_df.copy()
-                    warning_df['Тип'] = sheet_name
-                    warning_items.append(warning_df)
-            except Exception as e:
-                self.logger.log(f"Ошибка при чтении листа {sheet_name}: {e}")
-
-        # Сохраняем путь к файлу для последующего использования
-        self.last_excel_file_path = excel_file_to_use
+        sheets = self.read_sheets(excel_file_to_use)
+        for sheet_name, df in sheets.items():
+            self.logger.log(f"Читаем лист: {sheet_name}")
+            total_records += len(df)
+            # Все счетчики - один bincount по int8-кодам категорий (код -1 у пустого/неизвестного статуса)
+            codes = df['Статус'].cat.codes.to_numpy()
+            code_counts = np.bincount(codes + 1, minlength=len(self.status_dtype.categories) + 1)
+            for code, status in enumerate(self.status_dtype.categories):
+                status_counts[status] += int(code_counts[code + 1])
+
+            # Выборки - по маске кодов, без группировки; колонка 'Тип' добавляется через assign без явного copy()
+            found = []
+            for status, frames in frames_by_status.items():
+                rows = np.flatnonzero(codes == self.status_dtype.categories.get_loc(status))
+                found.append(f"{status}: {len(rows)}")
+                if len(rows):
+                    status_df = df.iloc[rows]
+                    frames.append(status_df.assign(Тип=pd.Series(sheet_name, index=status_df.index, dtype=self.type_dtype)))
+            self.logger.log(f"  Найдено {', '.join(found)}")
+
+        # Пустой результат с теми же категориальными типами, что и непустой
+        empty_df = pd.DataFrame(columns=self.config.COLUMN_NAMES + ['Тип']).astype({'Статус': self.status_dtype, 'Тип': self.type_dtype})
+        urgent_items = pd.concat(urgent_frames, ignore_index=True) if urgent_frames else empty_df
+        warning_items = pd.concat(warning_frames, ignore_index=True) if warning_frames else empty_df.copy()
+
+        # Кэшируются только полные чтения: при ошибке листа следующий вызов прочитает файл заново
+        if cache_key is not None and len(sheets) == len(self.config.SHEETS_CONFIG):
+            self._data_cache = (cache_key, (urgent_items, warning_items, total_records, dict(status_counts)))
         return urgent_items, warning_items, total_records, status_counts, recalc_success
 
     def get_last_excel_file_path(self) -> Path:
@@ -379,6 +527,28 @@ class ExcelHandler:
             self.logger.log(f"⚠️ {msg}")
             return False, msg
 
+    @staticmethod
+    def _index_rows_by_number(sheet) -> Dict[int, int]:
+        """
+        Строит соответствие "номер из колонки A (№)" -> "номер строки листа".
+        Данные начинаются со строки 5 (строка 4 - заголовки), просматривается до 500 строк;
+        при повторе номера используется первая строка.
+        """
+        start_row = 5
+        max_rows = 500
+        rows_by_number = {}
+        for row_idx, (cell_value,) in enumerate(
+                sheet.iter_rows(min_row=start_row, max_row=start_row + max_rows - 1,
+                                min_col=1, max_col=1, values_only=True), start=start_row):
+            if cell_value is None:
+                continue
+            try:
+                # Преобразуем значение ячейки в число
+                rows_by_number.setdefault(int(float(cell_value)), row_idx)
+            except (ValueError, TypeError):
+                continue
+        return rows_by_number
+
     def mark_as_serviced(self, sheet_name: str, row_number: str, make_backup: bool = True) -> Tuple[bool, str]:
         """
         Отмечает оборудование как обслуженное, обновляя дату последнего ТО.
@@ -416,30 +586,13 @@ class ExcelHandler:
                 
                 sheet = wb[sheet_name]
                 
-                # Ищем строку с нужным номером в колонке A (№)
-                # Колонка A (№) - индекс 1
-                # Колонка I (Дата последнего ТО) - индекс 9
-                start_row = 5  # Данные начинаются со строки 5 (строка 4 - заголовки)
-                max_rows = 500
-                found_row = None
-                
                 # Преобразуем row_number в число для сравнения
                 try:
                     target_number = int(row_number)
                 except ValueError:
                     return False, f"Некорректный номер строки: '{row_number}'"
                 
-                for row_idx in range(start_row, start_row + max_rows):
-                    cell_value = sheet.cell(row=row_idx, column=1).value  # Колонка A (№)
-                    if cell_value is not None:
-                        try:
-                            # Преобразуем значение ячейки в число
-                            cell_number = int(float(cell_value))
-                            if cell_number == target_number:
-                                found_row = row_idx
-                                break
-                        except (ValueError, TypeError):
-                            continue
+                found_row = self._index_rows_by_number(sheet).get(target_number)
                 
                 if found_row is None:
                     return False, f"Оборудование с номером '№{row_number}' не найдено на листе '{sheet_name}'"
@@ -465,6 +618,86 @@ class ExcelHandler:
             self.logger.log(f"❌ {error_msg}")
             return False, error_msg
 
+    def mark_many_as_serviced(self, items_by_sheet: Dict[str, List[str]],
+                              make_backup: bool = True) -> List[Tuple[str, str, bool, str]]:
+        """
+        Отмечает несколько единиц оборудования как обслуженное за одно открытие и одно сохранение книги.
+        
+        Args:
+            items_by_sheet: Номера строк из колонки № (колонка A), сгруппированные по названию листа
+            make_backup: Нужно ли создавать резервную копию перед изменением
+            
+        Returns:
+            List[Tuple[str, str, bool, str]]: (лист, номер, успех операции, сообщение) для каждой позиции
+        """
+        requested = [(sheet_name, row_number)
+                     for sheet_name, row_numbers in items_by_sheet.items()
+                     for row_number in row_numbers]
+
+        def fail_all(message: str) -> List[Tuple[str, str, bool, str]]:
+            return [(sheet_name, row_number, False, message) for sheet_name, row_number in requested]
+
+        file_path = self.config.get_excel_file_path()
+        if not file_path.exists():
+            return fail_all(f"Файл не найден: {file_path}")
+
+        if self.is_file_locked(file_path):
+            return fail_all("⚠️ Файл Excel открыт в другой программе! Закройте его перед выполнением операции.")
+
+        if make_backup:
+            self.create_backup(file_path)
+
+        try:
+            self.logger.log(f"📝 Отмечаем как обслуженное: {len(requested)} ед. оборудования")
+            wb = load_workbook(str(file_path))
+            try:
+                results = []
+                updated = []  # (номер, обозначение, строка) - для лога после сохранения
+                today = datetime.now()
+                for sheet_name, row_numbers in items_by_sheet.items():
+                    if sheet_name not in wb.sheetnames:
+                        results.extend((sheet_name, row_number, False, f"Лист '{sheet_name}' не найден в файле")
+                                       for row_number in row_numbers)
+                        continue
+
+                    sheet = wb[sheet_name]
+                    # Колонка A просматривается один раз на лист, а не для каждой позиции
+                    rows_by_number = self._index_rows_by_number(sheet)
+                    for row_number in row_numbers:
+                        try:
+                            target_number = int(row_number)
+                        except ValueError:
+                            results.append((sheet_name, row_number, False,
+                                            f"Некорректный номер строки: '{row_number}'"))
+                            continue
+
+                        found_row = rows_by_number.get(target_number)
+                        if found_row is None:
+                            results.append((sheet_name, row_number, False,
+                                            f"Оборудование с номером '№{row_number}' не найдено на листе '{sheet_name}'"))
+                            continue
+
+                        # Обозначение - колонка D = 4, дата последнего ТО - колонка I = 9
+                        designation = sheet.cell(row=found_row, column=4).value or "N/A"
+                        sheet.cell(row=found_row, column=9).value = today
+                        updated.append((row_number, designation, found_row))
+                        results.append((sheet_name, row_number, True,
+                                        f"Оборудование '№{row_number} ({designation})' отмечено как обслуженное"))
+
+                if updated:
+                    wb.save(str(file_path))
+                    for row_number, designation, found_row in updated:
+                        self.logger.log(f"✅ Успешно обновлена дата ТО для '№{row_number} ({designation})' в строке {found_row}")
+                return results
+
+            finally:
+                wb.close()
+
+        except Exception as e:
+            error_msg = f"Ошибка при обновлении: {str(e)}"
+            self.logger.log(f"❌ {error_msg}")
+            return fail_all(error_msg)
+
 # --- 4. Логика обслуживания ---
 class MaintenanceChecker:
     """Класс для анализа статусов обслуживания."""
@@ -491,57 +724,72 @@ class MaintenanceChecker:
             return ""
         return str(value)
 
-    def format_item_info(self, item: pd.Series, item_type: str) -> str:
-        """Форматирует информацию об элементе."""
-        emoji = "💻" if "ПК" in item_type else ("📦" if "Шкаф" in item_type else "⚙️")
-
-        raboty_row = ""
-        if not pd.isna(item['Работы']):
-            raboty_value = self.format_field_value(item['Работы'])
-            raboty_row = f"<tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Работы:</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{raboty_value}</td></tr>"
-
-        return f"""
+    ITEM_INFO_TEMPLATE = """
 <div style='margin-bottom: 10px;'>
     <table style='width: 100%; border-collapse: collapse; font-size: 14px;'>
         <tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Тип:</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{emoji}  {item_type}</td></tr>
-        <tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Объект:</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{item['Объект']}</td></tr>
-        <tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Наименование:</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{item['Наименование']}</td></tr>
-        <tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Обозначение:</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{item['Обозначение']}</td></tr>
-        <tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Место расположения:</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{item['Место расположения']}</td></tr>
-        {raboty_row}
-        <tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Интервал ТО (дней):</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{item['Интервал ТО (дней)']}</td></tr>
-        <tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Дата последнего ТО:</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{self.format_date(item['Дата последнего ТО'])}</td></tr>
-        <tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Дата следующего ТО:</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{self.format_date(item['Дата следующего ТО'])}</td></tr>
-        <tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Статус:</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{item['Статус']}</td></tr>
+        <tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Объект:</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{object}</td></tr>
+        <tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Наименование:</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{name}</td></tr>
+        <tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Обозначение:</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{designation}</td></tr>
+        <tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Место расположения:</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{location}</td></tr>
+        {works_row}
+        <tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Интервал ТО (дней):</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{interval_days}</td></tr>
+        <tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Дата последнего ТО:</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{last_date}</td></tr>
+        <tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Дата следующего ТО:</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{next_date}</td></tr>
+        <tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Статус:</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{status}</td></tr>
     </table>
 </div>
 """
 
-    def format_item_table_row(self, item: pd.Series, bg_color: str) -> str:
-        """Форматирует строку таблицы для элемента (аналогично web-интерфейсу)."""
-        # Получаем значения, обрабатывая NaN
-        works = self.format_field_value(item['Работы']) if not pd.isna(item['Работы']) else ''
-        
-        # Форматируем интервал как целое число
-        interval_days = int(item['Интервал ТО (дней)']) if not pd.isna(item['Интервал ТО (дней)']) else ''
-        
-        # Определяем цвет статуса
-        status = item['Статус']
-        status_color = '#e74c3c' if status == self.config.STATUS_URGENT else '#f39c12'
-        
-        return f"""
-                    <tr style='background-color: {bg_color};'>
-                        <td style='padding:8px; border:1px solid #cfd8dc;'>{item['Объект']}</td>
-                        <td style='padding:8px; border:1px solid #cfd8dc;'>{item['Наименование']}</td>
-                        <td style='padding:8px; border:1px solid #cfd8dc;'><strong>{item['Обозначение']}</strong></td>
-                        <td style='padding:8px; border:1px solid #cfd8dc;'>{item['Место расположения']}</td>
-                        <td style='padding:8px; border:1px solid #cfd8dc;'>{works}</td>
-                        <td style='padding:8px; border:1px solid #cfd8dc;'>{interval_days}</td>
-                        <td style='padding:8px; border:1px solid #cfd8dc;'>{self.format_date(item['Дата последнего ТО'])}</td>
-                        <td style='padding:8px; border:1px solid #cfd8dc;'>{self.format_date(item['Дата следующего ТО'])}</td>
-                        <td style='padding:8px; border:1px solid #cfd8dc;'><div style='font-weight:bold; color:{status_color};'>{status}</div></td>
-                    </tr>
-"""
+    def format_item_info(self, item: Dict[str, Any], item_type: str) -> str:
+        """Форматирует информацию об элементе."""
+        emoji = "💻" if "ПК" in item_type else ("📦" if "Шкаф" in item_type else "⚙️")
+
+        works_row = ""
+        if not pd.isna(item['Работы']):
+            raboty_value = self.format_field_value(item['Работы'])
+            works_row = f"<tr><td style='padding: 1px 10px 1px 0; width: 200px; color:#2c3e50; vertical-align: top;'>Работы:</td><td style='padding: 1px 0; color:#2c3e50; font-weight: bold;'>{raboty_value}</td></tr>"
+
+        return self.ITEM_INFO_TEMPLATE.format_map({
+            'emoji': emoji,
+            'item_type': item_type,
+            'object': item['Объект'],
+            'name': item['Наименование'],
+            'designation': item['Обозначение'],
+            'location': item['Место расположения'],
+            'works_row': works_row,
+            'interval_days': item['Интервал ТО (дней)'],
+            'last_date': self.format_date(item['Дата последнего ТО']),
+            'next_date': self.format_date(item['Дата следующего ТО']),
+            'status': item['Статус'],
+        })
+
+    def format_date_column(self, values: pd.Series) -> pd.Series:
+        """Форматирует колонку дат в dd.mm.yyyy целиком (для datetime64 - векторно)."""
+        if pd.api.types.is_datetime64_any_dtype(values):
+            return values.dt.strftime('%d.%m.%Y').fillna("Не указана")
+        return values.map(self.format_date)
+
+    def prepare_table_rows(self, items: pd.DataFrame) -> List[Dict[str, Any]]:
+        """Готовит строки таблицы письма для элементов (аналогично web-интерфейсу).
+
+        Даты, работы и интервалы форматируются сразу для всей колонки.
+        """
+        status = items['Статус'].astype(object)
+        prepared = pd.DataFrame({
+            'object': items['Объект'],
+            'name': items['Наименование'],
+            'designation': items['Обозначение'],
+            'location': items['Место расположения'],
+            'works': items['Работы'].map(self.format_field_value),
+            # Интервал выводим целым числом
+            'interval_days': items['Интервал ТО (дней)'].map(lambda value: '' if pd.isna(value) else int(value)),
+            'last_date': self.format_date_column(items['Дата последнего ТО']),
+            'next_date': self.format_date_column(items['Дата следующего ТО']),
+            'status': status,
+            'status_color': np.where(status == self.config.STATUS_URGENT, '#e74c3c', '#f39c12'),
+        }, index=items.index)
+        return prepared.to_dict('records')
 
 # --- 5. Статистика ---
 class StatisticsManager:
@@ -550,14 +798,62 @@ class StatisticsManager:
         self.config = config
         self.logger = logger
         self.history_file = self.config.HISTORY_FILE
+        self.legacy_history_file = self.config.LEGACY_HISTORY_FILE
+        self._history_arrays_cache: Optional[Tuple[Tuple[int, int], Dict[str, np.ndarray]]] = None
+        self._config_cache: Optional[Tuple[int, Dict[str, Any]]] = None
+        # Web-панель обновляет статистику из разных потоков: чтение-изменение-запись истории
+        # выполняется под блокировкой (RLock - save_config вызывается и изнутри update_statistics)
+        self._history_lock = threading.RLock()
+        # Проверка ключа и перезапись пары .png/.key диаграммы не должны перемежаться между потоками
+        self._chart_lock = threading.Lock()
+
+    def _history_file_mtime(self) -> Optional[int]:
+        """Возвращает mtime (нс) сжатого файла истории или None, если файла нет."""
+        try:
+            return self.history_file.stat().st_mtime_ns
+        except OSError:
+            return None
+
+    @staticmethod
+    def _copy_config(config: Dict[str, Any]) -> Dict[str, Any]:
+        """Копия конфигурации для вызывающего кода: список истории свой, записи общие (не изменяются)."""
+        return {**config, 'maintenance_history': list(config['maintenance_history'])}
+
+    @staticmethod
+    def _loads_json(data: bytes) -> Any:
+        """Разбирает JSON через orjson, если он установлен, иначе через стандартный json."""
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+    @staticmethod
+    def _dumps_json(obj: Any) -> bytes:
+        """Сериализует объект в UTF-8 JSON через orjson, если он установлен, иначе через стандартный json."""
+        if orjson is not None:
+            return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
 
     def load_config(self) -> Dict[str, Any]:
-        """Загружает конфигурацию из JSON файла."""
+        """Загружает конфигурацию из сжатого JSON файла (или из устаревшего несжатого).
+
+        Разобранный сжатый файл кэшируется по mtime: статистика, диаграмма и web-панель
+        не разбирают JSON повторно, пока файл не изменился.
+        """
         try:
-            if self.history_file.exists():
-                with open(self.history_file, 'r', encoding='utf-8') as f:
-                    config = json.load(f)
-                    return self._validate_config_structure(config)
+            mtime = self._history_file_mtime()
+            if mtime is not None:
+                if self._config_cache is not None and self._config_cache[0] == mtime:
+                    return self._copy_config(self._config_cache[1])
+                with gzip.open(self.history_file, 'rb') as f:
+                    config = self._validate_config_structure(self._loads_json(f.read()))
+                self._config_cache = (mtime, config)
+                return self._copy_config(config)
+            elif self.legacy_history_file.exists():
+                with open(self.legacy_history_file, 'r', encoding='utf-8') as f:
+                    config = self._validate_config_structure(json.load(f))
+                # Прежние версии не гарантировали порядок записей; сжатый файл всегда отсортирован по дате
+                config['maintenance_history'].sort(key=lambda record: record.get('date', ''))
+                return config
             else:
                 return self._create_default_config()
         except Exception as e:
@@ -584,58 +880,88 @@ class StatisticsManager:
         self.save_config(config)
         return config
 
-    def save_config(self, config: Dict[str, Any]) -> None:
-        """Сохраняет конфигурацию в JSON файл."""
+    def save_config(self, config: Dict[str, Any]) -> bool:
+        """Сохраняет конфигурацию в сжатый JSON файл. Возвращает True, если файл записан."""
         try:
-            config['last_update'] = datetime.now().isoformat()
-            config['version'] = self.config.VERSION
-            with open(self.history_file, 'w', encoding='utf-8') as f:
-                json.dump(config, f, ensure_ascii=False, indent=2)
+            with self._history_lock:
+                config['last_update'] = datetime.now().isoformat()
+                config['version'] = self.config.VERSION
+                # Пишем во временный файл и атомарно подменяем: прерванная запись не портит историю.
+                # Имя временного файла свое у каждого процесса и потока (панель и скрипт рассылки
+                # могут писать одновременно) - писатели не затирают и не удаляют чужие файлы
+                tmp_file = self.history_file.with_name(
+                    f"{self.history_file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+                try:
+                    # compresslevel=1: файл небольшой, важнее скорость, чем степень сжатия
+                    with gzip.open(tmp_file, 'wb', compresslevel=1) as f:
+                        f.write(self._dumps_json(config))
+                    tmp_file.replace(self.history_file)
+                finally:
+                    tmp_file.unlink(missing_ok=True)
+                mtime = self._history_file_mtime()
+                self._config_cache = (mtime, self._copy_config(config)) if mtime is not None else None
             self.logger.log(f"✅ Статистика сохранена в {self.history_file}")
+            return True
         except Exception as e:
             self.logger.log(f"❌ Ошибка при сохранении конфигурации: {e}")
+            return False
 
-    def update_statistics(self, urgent_items: List[pd.DataFrame],
-                          warning_items: List[pd.DataFrame],
+    def update_statistics(self, urgent_items: pd.DataFrame,
+                          warning_items: pd.DataFrame,
                           total_records: int,
-                          status_counts: Dict[str, int]) -> Dict[str, Any]:
-        """Обновляет статистику обслуживания."""
-        config = self.load_config()
-        today = datetime.now().date()
-        today_str = today.isoformat()
-        self.logger.log(f"🔍 Проверяем существование записи за {today.strftime('%d.%m.%Y')}...")
-
-        ok_count = status_counts.get(self.config.STATUS_OK, 0)
-        maintenance_record = {
-            "date": today_str,
-            "total_equipment": total_records,
-            "ok": ok_count,
-            "urgent": status_counts.get(self.config.STATUS_URGENT, 0),
-            "warning": status_counts.get(self.config.STATUS_WARNING, 0),
-            "timestamp": datetime.now().isoformat()
-        }
-
-        today_record_index = next((i for i, record in enumerate(config['maintenance_history']) if record['date'] == today_str), None)
+                          status_counts: Dict[str, int]) -> bool:
+        """Обновляет статистику обслуживания. Возвращает True, если запись за сегодня сохранена."""
+        # Чтение, изменение и запись истории - под одной блокировкой: параллельное обновление
+        # не должно потерять запись другого потока
+        with self._history_lock:
+            config = self.load_config()
+            today = datetime.now().date()
+            today_str = today.isoformat()
+            self.logger.log(f"🔍 Проверяем существование записи за {today.strftime('%d.%m.%Y')}...")
+
+            ok_count = status_counts.get(self.config.STATUS_OK, 0)
+            maintenance_record = {
+                "date": today_str,
+                "total_equipment": total_records,
+                "ok": ok_count,
+                "urgent": status_counts.get(self.config.STATUS_URGENT, 0),
+                "warning": status_counts.get(self.config.STATUS_WARNING, 0),
+                "timestamp": datetime.now().isoformat()
+            }
 
-        try:
-            if today_record_index is not None:
-                self.logger.log(f"📝 Перезаписываем существующую запись за {today.strftime('%d.%m.%Y')}...")
-                config['maintenance_history'][today_record_index] = maintenance_record
-                action = "обновлена"
+            history = config['maintenance_history']
+            # История хранится отсортированной по дате: запись за сегодня, если есть, - последняя (O(1))
+            in_order = not history or history[-1]['date'] <= today_str
+            if in_order:
+                today_record_index = len(history) - 1 if history and history[-1]['date'] == today_str else None
             else:
-                self.logger.log(f"📝 Создаем новую запись за {today.strftime('%d.%m.%Y')}...")
-                config['maintenance_history'].append(maintenance_record)
-                action = "добавлена"
+                # Есть записи с датой позже сегодняшней (перевод часов, ручная правка) - поиск по индексу дат
+                today_record_index = {record['date']: i for i, record in enumerate(history)}.get(today_str)
 
-            if len(config['maintenance_history']) > self.config.HISTORY_MAX_DAYS + 5:
-                config['maintenance_history'] = config['maintenance_history'][-self.config.HISTORY_MAX_DAYS:]
-
-            self.save_config(config)
-            self.logger.log(f"✅ Запись за {today.strftime('%d.%m.%Y')} {action}: {ok_count} обслужено")
-            return config
-        except Exception as e:
-            self.logger.log(f"❌ Ошибка при обновлении статистики: {e}")
-            return config
+            try:
+                if today_record_index is not None:
+                    self.logger.log(f"📝 Перезаписываем существующую запись за {today.strftime('%d.%m.%Y')}...")
+                    config['maintenance_history'][today_record_index] = maintenance_record
+                    action = "обновлена"
+                else:
+                    self.logger.log(f"📝 Создаем новую запись за {today.strftime('%d.%m.%Y')}...")
+                    config['maintenance_history'].append(maintenance_record)
+                    action = "добавлена"
+
+                # История должна оставаться отсортированной по дате (на это опирается get_statistics);
+                # при обычном порядке запись за сегодня уже встала в конец
+                if not in_order:
+                    config['maintenance_history'].sort(key=lambda record: record['date'])
+                if len(config['maintenance_history']) > self.config.HISTORY_MAX_DAYS + 5:
+                    config['maintenance_history'] = config['maintenance_history'][-self.config.HISTORY_MAX_DAYS:]
+
+                if not self.save_config(config):
+                    return False
+                self.logger.log(f"✅ Запись за {today.strftime('%d.%m.%Y')} {action}: {ok_count} обслужено")
+                return True
+            except Exception as e:
+                self.logger.log(f"❌ Ошибка при обновлении статистики: {e}")
+                return False
 
     def _compute_period_boundaries(self, base_date: date) -> Dict[str, date]:
         """Вычисляет границы периодов для статистики."""
@@ -666,43 +992,62 @@ class StatisticsManager:
             "prev_prev_month_end": prev_prev_month_end_local,
         }
 
-    def _aggregate_raw_field(self, history_records: List[Dict],
-                            today_local: date,
-                            bounds: Dict[str, date],
-                            extract_value) -> Dict[str, int]:
-        """Агрегирует данные по периодам."""
-        raw = {
-            "today": 0,
-            "yesterday": 0,
-            "day_before_yesterday": 0,
-            "this_week": 0,
-            "last_week": 0,
-            "week_before_last": 0,
-            "this_month": 0,
-            "last_month": 0,
-            "month_before_last": 0,
+    def _get_history_arrays(self, history_records: List[Dict]) -> Dict[str, np.ndarray]:
+        """Возвращает историю в виде типизированных массивов NumPy (кэш по mtime файла)."""
+        try:
+            cache_key = (self.history_file.stat().st_mtime_ns, len(history_records))
+        except OSError:
+            cache_key = None
+        if cache_key is not None and self._history_arrays_cache is not None \
+                and self._history_arrays_cache[0] == cache_key:
+            return self._history_arrays_cache[1]
+        arrays = {
+            "date": np.array([rec['date'] for rec in history_records], dtype='datetime64[D]'),
+            "ok": np.array([rec.get('ok', rec.get('serviced', 0)) for rec in history_records], dtype=np.int64),
+            "urgent": np.array([rec.get('urgent', 0) for rec in history_records], dtype=np.int64),
+            "warning": np.array([rec.get('warning', 0) for rec in history_records], dtype=np.int64),
         }
-        for record in history_records:
-            record_date = datetime.fromisoformat(record['date']).date()
-            value = extract_value(record)
-            if record_date == today_local:
-                raw["today"] = value
-            elif record_date == bounds["yesterday"]:
-                raw["yesterday"] = value
-            elif record_date == bounds["day_before_yesterday"]:
-                raw["day_before_yesterday"] = value
-            elif bounds["week_start"] <= record_date <= today_local:
-                raw["this_week"] = max(raw["this_week"], value)
-            elif bounds["last_week_start"] <= record_date <= bounds["last_week_end"]:
-                raw["last_week"] = max(raw["last_week"], value)
-            elif bounds["prev_prev_week_start"] <= record_date <= bounds["prev_prev_week_end"]:
-                raw["week_before_last"] = max(raw["week_before_last"], value)
-            elif bounds["month_start"] <= record_date <= today_local:
-                raw["this_month"] = max(raw["this_month"], value)
-            elif bounds["last_month_start"] <= record_date <= bounds["last_month_end"]:
-                raw["last_month"] = max(raw["last_month"], value)
-            elif bounds["prev_prev_month_start"] <= record_date <= bounds["prev_prev_month_end"]:
-                raw["month_before_last"] = max(raw["month_before_last"], value)
+        if cache_key is not None:
+            self._history_arrays_cache = (cache_key, arrays)
+        return arrays
+
+    def _aggregate_raw_fields(self, record_dates: np.ndarray,
+                              fields: Dict[str, np.ndarray],
+                              today_local: date,
+                              bounds: Dict[str, date]) -> Dict[str, Dict[str, int]]:
+        """Агрегирует данные по периодам сразу для нескольких полей.
+
+        Периоды независимы и могут пересекаться: запись за сегодня входит и в текущую неделю,
+        и в текущий месяц. Для отдельных дней берется значение последней записи за день,
+        для недель и месяцев - максимум по окну.
+        """
+        d = record_dates
+        day = lambda value: np.datetime64(value, 'D')
+        between = lambda start, end: (d >= day(start)) & (d <= day(end))
+        periods = [
+            ("today", d == day(today_local)),
+            ("yesterday", d == day(bounds["yesterday"])),
+            ("day_before_yesterday", d == day(bounds["day_before_yesterday"])),
+            ("this_week", between(bounds["week_start"], today_local)),
+            ("last_week", between(bounds["last_week_start"], bounds["last_week_end"])),
+            ("week_before_last", between(bounds["prev_prev_week_start"], bounds["prev_prev_week_end"])),
+            ("this_month", between(bounds["month_start"], today_local)),
+            ("last_month", between(bounds["last_month_start"], bounds["last_month_end"])),
+            ("month_before_last", between(bounds["prev_prev_month_start"], bounds["prev_prev_month_end"])),
+        ]
+        # Поля складываются в матрицу (поле x запись): выборка по периоду - одна на все поля
+        field_names = list(fields)
+        values = np.vstack([fields[name] for name in field_names]) if field_names else np.empty((0, len(d)), dtype=np.int64)
+        raw = {name: {} for name in field_names}
+        for index, (period, mask) in enumerate(periods):
+            selected = values[:, mask]
+            for row, name in enumerate(field_names):
+                if not selected.shape[1]:
+                    raw[name][period] = 0
+                elif index < 3:  # today / yesterday / day_before_yesterday
+                    raw[name][period] = int(selected[row, -1])
+                else:
+                    raw[name][period] = max(0, int(selected[row].max()))
         return raw
 
     def _compute_delta_stats(self, raw_stats: Dict[str, int]) -> Dict[str, int]:
@@ -730,15 +1075,16 @@ class StatisticsManager:
             }
         today = datetime.now().date()
         bounds = self._compute_period_boundaries(today)
-        # Агрегируем данные для обслуженных и срочных элементов
-        ok_raw_stats = self._aggregate_raw_field(
-            config['maintenance_history'], today, bounds,
-            lambda rec: rec.get('ok', rec.get('serviced', 0))
-        )
-        urgent_raw_stats = self._aggregate_raw_field(
-            config['maintenance_history'], today, bounds,
-            lambda rec: rec.get('urgent', 0)
+        arrays = self._get_history_arrays(config['maintenance_history'])
+        # Записи упорядочены по дате: отбрасываем всё, что старше самого раннего периода
+        start = int(np.searchsorted(arrays["date"], np.datetime64(min(bounds.values()), 'D')))
+        record_dates = arrays["date"][start:]
+        # Агрегируем данные для обслуженных и срочных элементов за один проход
+        raw_stats = self._aggregate_raw_fields(
+            record_dates, {"ok": arrays["ok"][start:], "urgent": arrays["urgent"][start:]}, today, bounds
         )
+        ok_raw_stats = raw_stats["ok"]
+        urgent_raw_stats = raw_stats["urgent"]
         # Вычисляем дельты
         ok_delta_stats = self._compute_delta_stats(ok_raw_stats)
         urgent_delta_stats = self._compute_delta_stats(urgent_raw_stats)
@@ -752,45 +1098,48 @@ class StatisticsManager:
         merged["today"] = merged["delta_ok_day"]
         return merged
 
-    def _add_chart_labels(self, x: List[int],
-                         ok_vals: List[int],
-                         urgent_vals: List[int],
-                         warning_vals: List[int]) -> None:
-        """Добавляет подписи значений на диаграмму."""
-        for i, xpos in enumerate(x):
-            total_val = ok_vals[i] + urgent_vals[i] + warning_vals[i]
-            if total_val <= 0:
-                continue
-            # Подписи для "В норме" (самый нижний слой)
-            if ok_vals[i] > 0:
-                pct = ok_vals[i] / total_val * 100
-                if pct >= 5:
-                    y_pos = ok_vals[i] / 2
-                    plt.text(
-                        xpos, y_pos,
-                        f"{ok_vals[i]}",
-                        ha='center', va='center', rotation=90, fontsize=6, color='white'
-                    )
-            # Подписи для "Внимание" (посередине)
-            if warning_vals[i] > 0:
-                pct = warning_vals[i] / total_val * 100
-                if pct >= 5:
-                    y_pos = ok_vals[i] + warning_vals[i] / 2
-                    plt.text(
-                        xpos, y_pos,
-                        f"{warning_vals[i]}",
-                        ha='center', va='center', rotation=90, fontsize=6, color='black'
-                    )
-            # Подписи для "СРОЧНО" (сверху)
-            if urgent_vals[i] > 0:
-                pct = urgent_vals[i] / total_val * 100
-                if pct >= 5:
-                    y_pos = ok_vals[i] + warning_vals[i] + urgent_vals[i] / 2
-                    plt.text(
-                        xpos, y_pos,
-                        f"{urgent_vals[i]}",
-                        ha='center', va='center', rotation=90, fontsize=6, color='white'
-                    )
+    def _get_figure_class(self):
+        """Лениво импортирует matplotlib: он нужен только при построении диаграммы.
+
+        Используется объектный API (Figure) без pyplot: нет глобального состояния,
+        поэтому построение безопасно и из потоков web-сервера.
+        Без matplotlib возвращает None - письмо и web-панель обходятся без диаграммы.
+        """
+        try:
+            from matplotlib.figure import Figure
+        except ImportError:
+            self.logger.log("💡 Для построения диаграммы установите: pip install matplotlib")
+            return None
+        return Figure
+
+    @staticmethod
+    def _chart_labels(values: np.ndarray, totals: np.ndarray) -> List[str]:
+        """Подписи столбцов слоя: значение, если оно не меньше 5% от суммы за день."""
+        visible = (values > 0) & (values * 100 >= totals * 5)
+        return [str(value) if show else '' for value, show in zip(values.tolist(), visible.tolist())]
+
+    def _add_chart_labels(self, ax, bars_with_values: List[Tuple[Any, np.ndarray, str]],
+                          totals: np.ndarray) -> None:
+        """Добавляет подписи значений на диаграмму: один вызов bar_label на слой."""
+        for bars, values, color in bars_with_values:
+            ax.bar_label(bars, labels=self._chart_labels(values, totals), label_type='center',
+                         rotation=90, fontsize=6, color=color)
+
+    def _chart_path(self, offset_days: int) -> Path:
+        """Путь диаграммы: за сегодня - в DATA_DIR (её прикладывают к письму), со смещением - в TMP_DIR.
+
+        Диаграмма, запрошенная панелью за другую дату, не перезаписывает ту, что уходит в письмо.
+        Все смещения делят один файл (перезаписывается под self._chart_lock), чтобы
+        просмотр произвольных дат не оставлял по файлу на каждый день.
+        """
+        if offset_days == 0:
+            return self.config.DATA_DIR / 'maintenance_status_chart.png'
+        return self.config.TMP_DIR / 'maintenance_status_chart_offset.png'
+
+    @staticmethod
+    def _temp_path(path: Path) -> Path:
+        """Временный файл рядом с path, свой у каждого процесса и потока."""
+        return path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
 
     def create_chart(self, offset_days: int = 0) -> Optional[Path]:
         """Создает диаграмму статусов обслуживания.
@@ -798,70 +1147,95 @@ class StatisticsManager:
         Args:
             offset_days: Смещение в днях от текущей даты (отрицательное = назад, положительное = вперед)
         """
+        with self._chart_lock:
+            return self._create_chart_locked(offset_days)
+
+    def _create_chart_locked(self, offset_days: int) -> Optional[Path]:
+        """Строит диаграмму (вызывается под self._chart_lock)."""
         try:
             config = self.load_config()
             if not config['maintenance_history']:
                 return None
             today = datetime.now().date() + timedelta(days=offset_days)
             start_date = today - timedelta(days=self.config.CHART_DAYS - 1)
-            # Собираем значения за каждый день диапазона
-            date_to_vals = {}
-            for rec in config['maintenance_history']:
-                rec_date = datetime.fromisoformat(rec['date']).date()
-                if start_date <= rec_date <= today:
-                    date_to_vals[rec_date] = (
-                        rec.get('ok', rec.get('serviced', 0)),
-                        rec.get('urgent', 0),
-                        rec.get('warning', 0),
-                    )
-            # Подготавливаем данные для графика
+            # Матрица дни x (норма, срочно, внимание) по уже разобранным массивам истории:
+            # номер дня в диапазоне - разность datetime64, без разбора строк дат
+            arrays = self._get_history_arrays(config['maintenance_history'])
+            day_index = (arrays["date"] - np.datetime64(start_date, 'D')).astype(np.int64)
+            in_range = (day_index >= 0) & (day_index < self.config.CHART_DAYS)
+            values = np.zeros((self.config.CHART_DAYS, 3), dtype=np.int64)
+            values[day_index[in_range]] = np.column_stack(
+                (arrays["ok"][in_range], arrays["urgent"][in_range], arrays["warning"][in_range])
+            )
             days_sorted = [start_date + timedelta(days=i) for i in range(self.config.CHART_DAYS)]
-            ok_vals = [date_to_vals.get(d, (0, 0, 0))[0] for d in days_sorted]
-            urgent_vals = [date_to_vals.get(d, (0, 0, 0))[1] for d in days_sorted]
-            warning_vals = [date_to_vals.get(d, (0, 0, 0))[2] for d in days_sorted]
+            ok_vals, urgent_vals, warning_vals = values.T
+            totals = values.sum(axis=1)
+            # Если данные диапазона не изменились, используем уже построенную диаграмму
+            chart_path = self._chart_path(offset_days)
+            key_path = chart_path.with_suffix('.key')
+            chart_key = hashlib.blake2b(
+                f"{self.config.VERSION}|{start_date.isoformat()}|{today.isoformat()}|".encode() + values.tobytes(),
+                digest_size=16,
+            ).hexdigest()
+            if chart_path.exists() and key_path.exists() and key_path.read_text(encoding='utf-8') == chart_key:
+                return chart_path
+            Figure = self._get_figure_class()
+            if Figure is None:
+                return None
             # Создаем график
-            x = list(range(len(days_sorted)))
-            plt.figure(figsize=(9, 3))
+            x = np.arange(len(days_sorted))
+            fig = Figure(figsize=(9, 3))
+            # Фиксированные поля вместо tight_layout (лишний проход компоновки)
+            fig.subplots_adjust(left=0.045, right=0.985, bottom=0.16, top=0.9)
+            ax = fig.add_subplot(111)
             # Настройка рамки
-            ax = plt.gca()
             for spine in ax.spines.values():
                 spine.set_color('#2c3e50')
                 spine.set_linewidth(0.8)
             # Правильный порядок слоев: снизу вверх
             # 1. "ОБСЛУЖИТЬ" (сверху) - поверх всех
-            bottom_stack = [ok_vals[i] + warning_vals[i] for i in range(len(x))]
-            urgent_bars = plt.bar(x, urgent_vals, bottom=bottom_stack, width=0.9, color='#e74c3c', label='ОБСЛУЖИТЬ')
+            urgent_bars = ax.bar(x, urgent_vals, bottom=ok_vals + warning_vals, width=0.9, color='#e74c3c', label='ОБСЛУЖИТЬ')
             # 2. "Внимание" (посередине) - поверх "В норме"
-            warning_bars = plt.bar(x, warning_vals, bottom=ok_vals, width=0.9, color='#f39c12', label='Внимание')
+            warning_bars = ax.bar(x, warning_vals, bottom=ok_vals, width=0.9, color='#f39c12', label='Внимание')
             # 3. "Не требуется" (самый нижний слой)
-            ok_bars = plt.bar(x, ok_vals, width=0.9, color='#18bc9c', label='Не требуется')
+            ok_bars = ax.bar(x, ok_vals, width=0.9, color='#18bc9c', label='Не требуется')
             # Добавляем подписи значений
-            self._add_chart_labels(x, ok_vals, urgent_vals, warning_vals)
+            self._add_chart_labels(ax, [
+                (ok_bars, ok_vals, 'white'),
+                (warning_bars, warning_vals, 'black'),
+                (urgent_bars, urgent_vals, 'white'),
+            ], totals)
             # Настраиваем оси и легенду
-            labels = [d.strftime('%d.%m') for d in days_sorted]
             tick_step = max(1, len(x) // 31)
-            tick_positions = list(range(0, len(x), tick_step))
-            tick_labels = [labels[i] for i in tick_positions]
-            plt.xticks(tick_positions, tick_labels, rotation=45, ha='right', fontsize=6, color="#2c3e50")
-            plt.yticks(fontsize=6, color="#2c3e50")
+            tick_positions = x[::tick_step]
+            tick_labels = [days_sorted[i].strftime('%d.%m') for i in tick_positions]
+            ax.set_xticks(tick_positions, tick_labels, rotation=45, ha='right', fontsize=6, color="#2c3e50")
+            ax.tick_params(axis='y', labelsize=6, labelcolor="#2c3e50")
             
             # Заголовок с указанием диапазона дат
             title = f'Статусы по дням ({start_date.strftime("%d.%m.%Y")} - {today.strftime("%d.%m.%Y")})'
-            plt.title(title, fontsize=7, color="#2c3e50")
-            plt.legend(loc='lower left', fontsize=7)
+            ax.set_title(title, fontsize=7, color="#2c3e50")
+            ax.legend(loc='lower left', fontsize=7)
             
             # Устанавливаем границы так, чтобы отступы от краев были чуть больше отступов между столбцами (+2 пикселя)
             # При ширине столбца 0.9, отступ между ними 0.1. 
             # Добавляем еще немного к отступам от краев (примерно 0.1 в единицах данных соответствует ~2 пикселя при текущем DPI)
-            plt.xlim(-0.65, len(x) - 0.35)
+            ax.set_xlim(-0.65, len(x) - 0.35)
             
-            plt.tight_layout()
-            plt.grid(axis='y', linestyle='--', linewidth=0.5, alpha=0.7)
-            # Сохраняем диаграмму
-            self.config.DATA_DIR.mkdir(parents=True, exist_ok=True)
-            chart_path = self.config.DATA_DIR / 'maintenance_status_chart.png'
-            plt.savefig(chart_path, dpi=150, bbox_inches='tight', pad_inches=0.05)
-            plt.close()
+            ax.grid(axis='y', linestyle='--', linewidth=0.5, alpha=0.7)
+            # Сохраняем диаграмму и ключ через временные файлы с атомарной подменой:
+            # читатель уже выданного пути не увидит наполовину записанный PNG
+            chart_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_chart = self._temp_path(chart_path)
+            tmp_key = self._temp_path(key_path)
+            try:
+                fig.savefig(tmp_chart, format='png', dpi=150, bbox_inches='tight', pad_inches=0.05)
+                tmp_key.write_text(chart_key, encoding='utf-8')
+                tmp_chart.replace(chart_path)
+                tmp_key.replace(key_path)
+            finally:
+                tmp_chart.unlink(missing_ok=True)
+                tmp_key.unlink(missing_ok=True)
             return chart_path
         except Exception as e:
             self.logger.log(f"❌ Не удалось построить диаграмму: {e}")
@@ -871,11 +1245,16 @@ class StatisticsManager:
 class ServicedEquipmentManager:
     """Класс для управления историей обслуженного оборудования."""
     
-    def __init__(self, config: Config, logger: DualLogger):
+    def __init__(self, config: Config, logger: DualLogger, excel_handler: ExcelHandler):
         self.config = config
         self.logger = logger
         self.serviced_history_file = config.SERVICED_HISTORY_FILE
         self.excel_snapshot_file = config.EXCEL_SNAPSHOT_FILE
+        self.excel_handler = excel_handler
+
+    def _read_equipment_sheets(self, excel_file_path: Path) -> Dict[str, pd.DataFrame]:
+        """Читает все листы оборудования тем же читателем, что и ExcelHandler.read_data."""
+        return self.excel_handler.read_sheets(excel_file_path)
     
     # === Работа со снимком дат ТО ===
     def load_snapshot(self) -> Dict[str, str]:
@@ -920,18 +1299,9 @@ class ServicedEquipmentManager:
         
         try:
             # Читаем все листы напрямую из Excel
-            for sheet_name in self.config.SHEETS_CONFIG.keys():
-                # Читаем данные из Excel
-                df = pd.read_excel(excel_file_path, sheet_name=sheet_name, header=3, nrows=500)
-                
-                if len(df.columns) > len(self.config.COLUMN_NAMES):
-                    df = df.iloc[:, :len(self.config.COLUMN_NAMES)]
-                df.columns = self.config.COLUMN_NAMES
-                df = df.dropna(how='all')
-                
-                # Проходим по всем строкам
-                for _, row in df.iterrows():
-                    row_num = row.get('№')
+            for sheet_name, df in self._read_equipment_sheets(excel_file_path).items():
+                # Проходим по всем строкам (только нужные колонки, кортежами)
+                for row_num, last_date in df[['№', 'Дата последнего ТО']].itertuples(index=False, name=None):
                     if pd.isna(row_num):
                         continue
                     
@@ -941,7 +1311,6 @@ class ServicedEquipmentManager:
                         continue
                     
                     key = f"{sheet_name}:{row_num}"
-                    last_date = row.get('Дата последнего ТО')
                     
                     if pd.notna(last_date):
                         if hasattr(last_date, 'strftime'):
@@ -1087,16 +1456,9 @@ class ServicedEquipmentManager:
         
         try:
             # Читаем все листы напрямую из Excel
-            for sheet_name in self.config.SHEETS_CONFIG.keys():
-                df = pd.read_excel(excel_file_path, sheet_name=sheet_name, header=3, nrows=500)
-                
-                if len(df.columns) > len(self.config.COLUMN_NAMES):
-                    df = df.iloc[:, :len(self.config.COLUMN_NAMES)]
-                df.columns = self.config.COLUMN_NAMES
-                df = df.dropna(how='all')
-                
-                for _, row in df.iterrows():
-                    row_num = row.get('№')
+            for sheet_name, df in self._read_equipment_sheets(excel_file_path).items():
+                columns = ['№', 'Обозначение', 'Наименование', 'Объект']
+                for row_num, designation, name, obj in df[columns].itertuples(index=False, name=None):
                     if pd.isna(row_num):
                         continue
                     
@@ -1110,9 +1472,9 @@ class ServicedEquipmentManager:
                     equipment_data[key] = {
                         'sheet': sheet_name,
                         'row': row_num,
-                        'designation': row.get('Обозначение', ''),
-                        'name': row.get('Наименование', ''),
-                        'object': row.get('Объект', '')
+                        'designation': designation,
+                        'name': name,
+                        'object': obj
                     }
                     
         except Exception as e:
@@ -1218,302 +1580,181 @@ class ReportGenerator:
         self.maintenance_checker = maintenance_checker
         self.statistics_manager = statistics_manager
         self.serviced_equipment_manager = serviced_equipment_manager
-
-    def _create_serviced_email_block(self, serviced_records: List[Dict[str, Any]]) -> str:
-        """Создаёт HTML-блок для обслуженного оборудования за последние 7 дней."""
-        if not serviced_records:
-            return ""
-        
-        # Группируем по датам
+        # Шаблон письма компилируется один раз; экранирование выключено, как и при прежней сборке строк
+        self.email_environment = Environment(loader=FileSystemLoader(str(self.config.TEMPLATES_DIR)), autoescape=False,
+                                             bytecode_cache=self.config.get_jinja_bytecode_cache('email'))
+        self.email_template = self.email_environment.get_template('email_report.html')
+        # Постоянные на время работы процесса значения подвала письма
+        self.script_path = Path(__file__).resolve()
+        self.recipients_text = ', '.join(self.config.RECIPIENTS)
+
+    def _group_serviced_records(self, serviced_records: List[Dict[str, Any]]) -> List[Tuple[str, List[Dict[str, Any]]]]:
+        """Группирует обслуженное оборудование по датам (свежие сверху) для блока письма."""
         by_date = {}
         for record in serviced_records:
-            date_str = record.get('date', '')
-            if date_str not in by_date:
-                by_date[date_str] = []
-            by_date[date_str].append(record)
-        
-        html_parts = []
-        html_parts.append("<br/>")
-        html_parts.append("<div style='background-color: #f8f9fa; border-radius: 8px; padding: 15px; border-left: 4px solid #18bc9c; margin-bottom: 20px;'>")
-        html_parts.append("<div style='font-size: 15px; font-weight: bold; color: #2c3e50; margin-bottom: 10px;'>📝 Обслужено за последние 7 дней</div>")
-        
+            by_date.setdefault(record.get('date', ''), []).append(record)
+
+        groups = []
         for date_str in sorted(by_date.keys(), reverse=True):
-            records = by_date[date_str]
             # Форматируем дату
             try:
-                date_obj = datetime.strptime(date_str, '%Y-%m-%d')
-                formatted_date = date_obj.strftime('%d.%m.%Y')
-            except:
+                formatted_date = datetime.strptime(date_str, '%Y-%m-%d').strftime('%d.%m.%Y')
+            except ValueError:
                 formatted_date = date_str
-            
-            html_parts.append(f"<div style='font-size: 13px; font-weight: bold; color: #18bc9c; margin-top: 10px; margin-bottom: 5px;'>📅 {formatted_date} ({len(records)} ед.)</div>")
-            html_parts.append("<table style='width: 100%; border-collapse: collapse; font-size: 12px; table-layout: fixed;'>")
-            html_parts.append("<thead><tr style='background-color: #e8f5e9;'>")
-            html_parts.append("<th style='padding: 6px; border: 1px solid #cfd8dc; text-align: left; width: 150px;'>Объект</th>")
-            html_parts.append("<th style='padding: 6px; border: 1px solid #cfd8dc; text-align: left; width: 200px;'>Обозначение</th>")
-            html_parts.append("<th style='padding: 6px; border: 1px solid #cfd8dc; text-align: left;'>Наименование</th>")
-            html_parts.append("</tr></thead>")
-            html_parts.append("<tbody>")
-
-            for rec in records:
-                html_parts.append("<tr>")
-                html_parts.append(f"<td style='padding: 6px; border: 1px solid #cfd8dc; color: #2c3e50; width: 150px;'>{rec.get('object', '')}</td>")
-                html_parts.append(f"<td style='padding: 6px; border: 1px solid #cfd8dc; font-weight: bold; color: #2c3e50; width: 200px;'>{rec.get('designation', '')}</td>")
-                html_parts.append(f"<td style='padding: 6px; border: 1px solid #cfd8dc; color: #2c3e50;'>{rec.get('name', '')}</td>")
-                html_parts.append("</tr>")
-            
-            html_parts.append("</tbody></table>")
-        
-        html_parts.append("</div>")
-        return "".join(html_parts)
+            groups.append((formatted_date, by_date[date_str]))
+        return groups
 
-    def create_body(self, urgent_items: List[pd.DataFrame],
-                    warning_items: List[pd.DataFrame],
+    def create_body(self, urgent_items: pd.DataFrame,
+                    warning_items: pd.DataFrame,
                     total_records: int,
                     status_counts: Dict[str, int],
                     recalc_success: bool = True) -> Tuple[str, Optional[Path]]:
-        """Создает HTML-тело письма."""
+        """Создает HTML-тело письма одним рендером шаблона templates/email_report.html."""
         # Вычисляем процент необслуженного оборудования
         unserviced_count = status_counts[self.config.STATUS_URGENT] #+ status_counts[self.config.STATUS_WARNING]
         unserviced_percentage = (unserviced_count / total_records * 100) if total_records > 0 else 0
-        html_parts: List[str] = []
-        
-        # Обертка для всей почты, чтобы ограничить ширину и выровнять элементы
-        html_parts.append("<div style='width: 100%; max-width: 1200px; font-family: Segoe UI, Tahoma, Geneva, Verdana, sans-serif;'>")
-        
-        # Предупреждение о неудачном пересчете формул
-        if not recalc_success:
-            html_parts.append(
-                f"""
-                <div style="background-color: #ff6b6b; border-radius: 8px; padding: 15px; border-left: 5px solid #e74c3c;
-                            color: white; margin-bottom: 20px; display: flex; align-items: center;">
-                    <div style="margin-right: 15px;">
-                        <img src="cid:app_icon_alert" alt="Иконка приложения" style="width: 86px; height: 86px; border-radius: 8px;">
-                    </div>
-                    <div style="text-align: left;">
-                        <div style="font-size: 16px; font-weight: bold; margin-bottom: 10px;">⚠️ ВНИМАНИЕ! ТАБЛИЦА ОТКРЫТА! ⚠️</div>
-                        <div style="font-size: 16px; line-height: 1.4;">
-                            Перерасчёт графика обслуживания невозможен!<br/>
-                            Закройте таблицу чтобы восстановить расчёты, или живите дальше в проклятом мире, который сами и создали!
-                        </div>
-                    </div>
-                </div>
-                """
-            )
-        # Верхняя сводка - компактный вариант с названиями над цифрами #2c3e50 #2c3e50
-        html_parts.append(
-            f"""
-            <div style="background-color: #2c3e50; border-radius: 8px; padding: 15px; border-left: 4px solid #18bc9c;
-                        color: white;">
-                <div style="display: flex; justify-content: space-around; text-align: center; flex-wrap: wrap;">
-                    <div style="margin: 5px; ">
-                        <div style="font-size: 12px; color: #ffd6d6; margin-bottom: 3px;">🚨 ОБСЛУЖИТЬ</div>
-                        <div style="font-size: 20px; font-weight: bold; color: #ff6b6b;">{status_counts[self.config.STATUS_URGENT]} ({unserviced_percentage:.1f}%) </div>
-                    </div>
-                    <div style="margin: 5px; margin-left: 20px;">
-                        <div style="font-size: 12px; color: #ffe082; margin-bottom: 3px;">⚠️ Внимание</div>
-                        <div style="font-size: 20px; font-weight: bold; color: #ffd54f;">{status_counts[self.config.STATUS_WARNING]}</div>
-                    </div>
-                    <div style="margin: 5px; margin-left: 20px;">
-                        <div style="font-size: 12px; color: #18bc9c; margin-bottom: 3px;">✅ Не требуется</div>
-                        <div style="font-size: 20px; font-weight: bold; color: #18bc9c;">{status_counts[self.config.STATUS_OK]}</div>
-                    </div>
-                    <div style="margin: 5px; margin-left: 20px;">
-                        <div style="font-size: 12px; color: #bbdefb; margin-bottom: 3px;">📊 Всего</div>
-                        <div style="font-size: 20px; font-weight: bold; color: #4fc3f7;">{total_records}</div>
-                    </div>
-                    <div style="margin-left: 25px;">
-                        <a href="http://10.100.59.40:5940/" title="Перейти в панель управления">
-                            <img src="cid:app_icon" alt="Иконка приложения" style="width: 52px; height: 52px; border-radius: 8px; border: none;">
-                        </a>
-                    </div>
-                </div>
-            </div>
-            <br/>
-            """
-        )
-        # Создаем диаграмму
+
+        # Создаем диаграмму (вставляется перед секцией срочных работ)
         chart_path = self.statistics_manager.create_chart()
-        # Вставляем диаграмму ПЕРЕД секцией срочных работ
-        if chart_path and Path(chart_path).exists():
-            html_parts.append(
-                (
-                    "<div style='margin-bottom: 20px;'>"
-                    "<img src=\"cid:status_chart\" alt=\"Диаграмма\" style='width: 100%; display: block; border-radius: 8px;'/>"
-                    "</div>"
-                )
-            )
-        # Срочные и внимание элементы в раздельных таблицах
-        if urgent_items or warning_items:
-            total_urgent = sum(len(df) for df in urgent_items) if urgent_items else 0
-            total_warning = sum(len(df) for df in warning_items) if warning_items else 0
-            
-            # 1. Срочные элементы
-            if urgent_items:
-                html_parts.append(f"<div><strong style='color:#e74c3c;'>🚨 ОБСЛУЖИТЬ (записей: {total_urgent}):</strong></div>")
-                html_parts.append("<hr style='background-color: #e74c3c; height: 2px; border: none;' />")
-                html_parts.append("""
-                <table style='width:100%; border-collapse:collapse; font-size:13px; margin-top:10px; margin-bottom:20px;'>
-                    <thead>
-                        <tr style='background-color:#2c3e50; color:white;'>
-                            <th style='padding:10px; text-align:left; border:1px solid #cfd8dc;'>Объект</th>
-                            <th style='padding:10px; text-align:left; border:1px solid #cfd8dc;'>Наименование</th>
-                            <th style='padding:10px; text-align:left; border:1px solid #cfd8dc;'>Обозначение</th>
-                            <th style='padding:10px; text-align:left; border:1px solid #cfd8dc;'>Место расположения</th>
-                            <th style='padding:10px; text-align:left; border:1px solid #cfd8dc;'>Работы</th>
-                            <th style='padding:10px; text-align:left; border:1px solid #cfd8dc;'>Инт. ТО</th>
-                            <th style='padding:10px; text-align:left; border:1px solid #cfd8dc;'>Дата ТО</th>
-                            <th style='padding:10px; text-align:left; border:1px solid #cfd8dc;'>Дата след. ТО</th>
-                            <th style='padding:10px; text-align:left; border:1px solid #cfd8dc;'>Статус</th>
-                        </tr>
-                    </thead>
-                    <tbody>
-                """)
-                
-                combined_urgent = pd.concat(urgent_items).sort_values(by='Объект')
-                color_index = 0
-                for _, item in combined_urgent.iterrows():
-                    bg_color = '#ffffff' if color_index % 2 == 0 else '#f9f9f9'
-                    html_parts.append(self.maintenance_checker.format_item_table_row(item, bg_color))
-                    color_index += 1
-                
-                html_parts.append("</tbody></table>")
-            
-            # 2. Элементы требующие внимания
-            if warning_items:
-                html_parts.append(f"<div><strong style='color:#f39c12;'>⚠️ ВНИМАНИЕ! Приближается срок обслуживания (записей: {total_warning}):</strong></div>")
-                html_parts.append("<hr style='background-color: #f39c12; height: 2px; border: none;' />")
-                html_parts.append("""
-                <table style='width:100%; border-collapse:collapse; font-size:13px; margin-top:10px; margin-bottom:20px;'>
-                    <thead>
-                        <tr style='background-color:#2c3e50; color:white;'>
-                            <th style='padding:10px; text-align:left; border:1px solid #cfd8dc;'>Объект</th>
-                            <th style='padding:10px; text-align:left; border:1px solid #cfd8dc;'>Наименование</th>
-                            <th style='padding:10px; text-align:left; border:1px solid #cfd8dc;'>Обозначение</th>
-                            <th style='padding:10px; text-align:left; border:1px solid #cfd8dc;'>Место расположения</th>
-                            <th style='padding:10px; text-align:left; border:1px solid #cfd8dc;'>Работы</th>
-                            <th style='padding:10px; text-align:left; border:1px solid #cfd8dc;'>Инт. ТО</th>
-                            <th style='padding:10px; text-align:left; border:1px solid #cfd8dc;'>Дата ТО</th>
-                            <th style='padding:10px; text-align:left; border:1px solid #cfd8dc;'>Дата след. ТО</th>
-                            <th style='padding:10px; text-align:left; border:1px solid #cfd8dc;'>Статус</th>
-                        </tr>
-                    </thead>
-                    <tbody>
-                """)
-                
-                combined_warning = pd.concat(warning_items).sort_values(by='Объект')
-                color_index = 0
-                for _, item in combined_warning.iterrows():
-                    bg_color = '#fffdf0' if color_index % 2 == 0 else '#fff9e6'
-                    html_parts.append(self.maintenance_checker.format_item_table_row(item, bg_color))
-                    color_index += 1
-                
-                html_parts.append("</tbody></table>")
 
-            html_parts.append("<br/>")
-        
         # Блок обслуженного оборудования за последние 7 дней
+        serviced_groups = []
         if self.serviced_equipment_manager:
             serviced_records = self.serviced_equipment_manager.get_serviced_last_days(7)
-            if serviced_records:
-                html_parts.append(self._create_serviced_email_block(serviced_records))
-        
-        # нижняя часть письма
-        html_parts.append(
-            f"""
-            <br/>
-            <div style="background-color: #EFF2F6; border-left: 4px solid #18bc9c; 
-                        padding: 12px; margin-top: 20px; font-size: 11px; color: #333;">
-                <div style="margin-bottom: 8px;">
-                    <span style="font-weight: bold;color:#2c3e50;">🔧 Скрипт рассылки уведомлений об обслуживании оборудования АСУТП</span> 
-                    <span style="float: right; background-color: #18bc9c; color: white; 
-                                padding: 2px 8px; border-radius: 10px; font-size: 10px;">
-                        v{self.config.VERSION} от {self.config.RELEASE_DATE}<br/> semonoff@gmail.com
-                    </span>
-                    <span style="float: right; margin-right: 8px "> 
-                        <img src="cid:app_icon" alt="Иконка приложения" style="width: 32px; height: 32px; border-radius: 8px;">
-                    </span>
-                </div>
-                <div style="line-height: 1.4;">
-                    <span style="color: #2c3e50;">📂 Файлы на сервере ASUTP-FILES-SRV01:</span><br/>
-                    <span style="margin-left: 15px;">📊 Таблица:</span> <code>{self.config.get_excel_file_path()}</code><br/>
-                    <span style="margin-left: 15px;">🐍 Скрипт:</span> <code>{Path(__file__).resolve()}</code> <br/>
-                    <span style="">⏰ Запуск:</span> Ежедневно из Task Scheduler, правило: <code>maintenance_alert.py</code><br/>
-                    <span style="">🖥️ Панель управления:</span> <a href="http://10.100.59.40:5940/" style="color: #18bc9c; text-decoration: none;">http://10.100.59.40:5940/</a><br/>
-                    <span style="">🌐 Исходный код:</span> <a href="https://github.com/SemonoffArt/maintenance_alert" style="color: #18bc9c; text-decoration: none;">GitHub репозиторий</a><br/>
-                    <span style="">📧 Получатели ({len(self.config.RECIPIENTS)}):</span> {', '.join(self.config.RECIPIENTS)}<br/>
-                    <div style="text-align: right; margin-top: 5px; color: #2c3e50; font-size: 10px;">
-                        Сформировано: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}
-                    </div>
-                </div>
-            </div>
-            """
+            serviced_groups = self._group_serviced_records(serviced_records)
+
+        html_body = self.email_template.render(
+            recalc_success=recalc_success,
+            urgent_count=status_counts[self.config.STATUS_URGENT],
+            unserviced_percentage=unserviced_percentage,
+            warning_count=status_counts[self.config.STATUS_WARNING],
+            ok_count=status_counts[self.config.STATUS_OK],
+            total_records=total_records,
+            has_chart=bool(chart_path and Path(chart_path).exists()),
+            urgent_rows=self.maintenance_checker.prepare_table_rows(urgent_items.sort_values(by='Объект')),
+            warning_rows=self.maintenance_checker.prepare_table_rows(warning_items.sort_values(by='Объект')),
+            serviced_groups=serviced_groups,
+            version=self.config.VERSION,
+            release_date=self.config.RELEASE_DATE,
+            excel_file_path=self.config.get_excel_file_path(),
+            script_path=self.script_path,
+            recipients_count=len(self.config.RECIPIENTS),
+            recipients_text=self.recipients_text,
+            generated_at=datetime.now().strftime('%d.%m.%Y %H:%M:%S'),
         )
-        html_parts.append("</div>") # Закрытие общей обертки
-        html_body = "".join(html_parts)
         return html_body, chart_path
 
 # --- 7. Отправка почты ---
 class EmailSender:
     """Класс для отправки email."""
-    def __init__(self, config: Config, logger: DualLogger):
+    def __init__(self, config: Config, logger: DualLogger, keep_connection: bool = False):
         self.config = config
         self.logger = logger
+        # Содержимое статичных иконок письма читается с диска один раз за время жизни процесса
+        self._icon_cache: Dict[Path, bytes] = {}
+        # Долгоживущий процесс (web-панель) держит SMTP-соединение между отправками,
+        # разовый запуск по расписанию открывает сессию на одно письмо
+        self.keep_connection = keep_connection
+        self._smtp: Optional[smtplib.SMTP] = None
+        self._smtp_lock = threading.Lock()
+
+    def _open_smtp(self) -> smtplib.SMTP:
+        """Открывает новое SMTP-соединение."""
+        # Не используем starttls() для порта 25 без шифрования
+        return smtplib.SMTP(self.config.SMTP_SERVER, self.config.SMTP_PORT,
+                            timeout=self.config.SMTP_TIMEOUT)
+
+    def _get_connection(self) -> smtplib.SMTP:
+        """Возвращает живое сохраненное соединение (проверка NOOP) или переподключается."""
+        if self._smtp is not None:
+            try:
+                if self._smtp.noop()[0] == 250:
+                    return self._smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._close_connection()
+        self._smtp = self._open_smtp()
+        return self._smtp
+
+    def _close_connection(self) -> None:
+        """Закрывает сохраненное соединение, игнорируя ошибки уже разорванной сессии."""
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._smtp = None
+
+    def close(self) -> None:
+        """Закрывает сохраненное SMTP-соединение (при завершении процесса)."""
+        with self._smtp_lock:
+            self._close_connection()
+
+    def _deliver(self, msg: EmailMessage, recipients: List[str]) -> None:
+        """Передает письмо SMTP-серверу."""
+        if not self.keep_connection:
+            # Одна SMTP-сессия на всех получателей; контекстный менеджер закрывает её и при ошибке
+            with self._open_smtp() as server:
+                server.send_message(msg, from_addr=self.config.SENDER_EMAIL, to_addrs=recipients)
+            return
+        with self._smtp_lock:
+            try:
+                self._get_connection().send_message(msg, from_addr=self.config.SENDER_EMAIL, to_addrs=recipients)
+            except smtplib.SMTPServerDisconnected:
+                # Сервер закрыл соединение между проверкой и отправкой - одна повторная попытка
+                self._close_connection()
+                self._get_connection().send_message(msg, from_addr=self.config.SENDER_EMAIL, to_addrs=recipients)
+
+    def _get_icon_bytes(self, icon_path: Path) -> Optional[bytes]:
+        """Возвращает содержимое иконки письма (с диска читается только при первом обращении)."""
+        icon_bytes = self._icon_cache.get(icon_path)
+        if icon_bytes is None and icon_path.exists():
+            icon_bytes = self._icon_cache[icon_path] = icon_path.read_bytes()
+        return icon_bytes
+
+    @staticmethod
+    def _read_chart_bytes(chart_path: Optional[Path]) -> Optional[bytes]:
+        """Возвращает содержимое PNG диаграммы или None, если диаграммы нет."""
+        if not chart_path:
+            return None
+        try:
+            return Path(chart_path).read_bytes()
+        except FileNotFoundError:
+            return None
 
     def send(self, html_body: str, recipients: List[str], chart_path: Optional[Path] = None, attachment_path: Optional[Path] = None) -> bool:
         """Отправляет email через SMTP."""
         try:
-            # Создаем сообщение
-            msg = MIMEMultipart('related')
+            # Создаем сообщение (EmailMessage сам строит multipart/related и multipart/mixed)
+            msg = EmailMessage()
             msg['From'] = self.config.SENDER_EMAIL
             msg['To'] = ", ".join(recipients)
             msg['Subject'] = "🔔 Напоминание о техническом обслуживании оборудования"
-            alternative = MIMEMultipart('alternative')
-            msg.attach(alternative)
-            # Добавляем HTML-контент и изображение при наличии
-            if chart_path and Path(chart_path).exists():
-                alternative.attach(MIMEText(html_body, 'html', 'utf-8'))
-                with open(chart_path, 'rb') as img_file:
-                    img = MIMEImage(img_file.read())
-                    img.add_header('Content-ID', '<status_chart>')
-                    img.add_header('Content-Disposition', 'inline', filename=Path(chart_path).name)
-                    msg.attach(img)
-            else:
-                alternative.attach(MIMEText(html_body, 'html', 'utf-8'))
-            # Добавляем иконку приложения
-            icon_path = self.config.DATA_DIR / "manky.png"
-            if icon_path.exists():
-                with open(icon_path, 'rb') as icon_file:
-                    icon = MIMEImage(icon_file.read())
-                    icon.add_header('Content-ID', '<app_icon>')
-                    icon.add_header('Content-Disposition', 'inline', filename='manky.png')
-                    msg.attach(icon)
-            # Добавляем иконку приложения
-            icon_path = self.config.DATA_DIR / "manky_alert.png"
-            if icon_path.exists():
-                with open(icon_path, 'rb') as icon_file:
-                    icon = MIMEImage(icon_file.read())
-                    icon.add_header('Content-ID', '<app_icon_alert>')
-                    icon.add_header('Content-Disposition', 'inline', filename='manky_alert.png')
-                    msg.attach(icon)
-            
+            # base64, как у прежнего MIMEText: не зависит от поддержки 8BITMIME сервером
+            msg.set_content(html_body, subtype='html', cte='base64')
+
+            # Добавляем изображение диаграммы при наличии (файл читается одним обращением, без проверки exists)
+            chart_bytes = self._read_chart_bytes(chart_path)
+            if chart_bytes is not None:
+                msg.add_related(chart_bytes, 'image', 'png', cid='<status_chart>',
+                                disposition='inline', filename=Path(chart_path).name)
+            # Добавляем иконки приложения (только те, на которые ссылается тело письма:
+            # иконка-предупреждение нужна лишь при неудачном пересчете формул)
+            for icon_name, content_id in (("manky.png", "app_icon"), ("manky_alert.png", "app_icon_alert")):
+                if f'cid:{content_id}"' not in html_body:
+                    continue
+                icon_bytes = self._get_icon_bytes(self.config.DATA_DIR / icon_name)
+                if icon_bytes is not None:
+                    msg.add_related(icon_bytes, 'image', 'png', cid=f'<{content_id}>',
+                                    disposition='inline', filename=icon_name)
+
             # Добавляем вложение с файлом maintenance_data.xlsx
             if attachment_path and attachment_path.exists():
-                with open(attachment_path, 'rb') as attachment_file:
-                    attachment = MIMEBase('application', 'vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-                    attachment.set_payload(attachment_file.read())
-                    encoders.encode_base64(attachment)
-                    attachment.add_header(
-                        'Content-Disposition',
-                        f'attachment; filename="{attachment_path.name}"'
-                    )
-                    msg.attach(attachment)
-                    self.logger.log(f"📎 Прикреплен файл: {attachment_path.name}")
-            # Подключаемся к SMTP серверу и отправляем письмо
-            server = smtplib.SMTP(self.config.SMTP_SERVER, self.config.SMTP_PORT)
-            # Не используем starttls() для порта 25 без шифрования
-            server.sendmail(self.config.SENDER_EMAIL, recipients, msg.as_string())
-            server.quit()
+                msg.add_attachment(attachment_path.read_bytes(), 'application',
+                                   'vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                                   filename=attachment_path.name)
+                self.logger.log(f"📎 Прикреплен файл: {attachment_path.name}")
+            self._deliver(msg, recipients)
             self.logger.log(f"✅ Письмо успешно отправлено {len(recipients)} получателям")
             return True
         except Exception as e:
@@ -1529,7 +1770,7 @@ class MaintenanceAlertApp:
         self.excel_handler = ExcelHandler(self.config, self.logger)
         self.maintenance_checker = MaintenanceChecker(self.config, self.logger)
         self.statistics_manager = StatisticsManager(self.config, self.logger)
-        self.serviced_equipment_manager = ServicedEquipmentManager(self.config, self.logger)
+        self.serviced_equipment_manager = ServicedEquipmentManager(self.config, self.logger, self.excel_handler)
         self.report_generator = ReportGenerator(self.config, self.logger, self.maintenance_checker, 
                                                  self.statistics_manager, self.serviced_equipment_manager)
         self.email_sender = EmailSender(self.config, self.logger)
@@ -1541,22 +1782,8 @@ class MaintenanceAlertApp:
         self.logger.log(f"🐍 Python: {sys.version.split()[0]}")
         self.logger.log_separator()
 
-    def run(self):
-        """Основная функция программы."""
-        self.show_version()
-        self.logger.log("🚀 ПРОГРАММА ЗАПУЩЕНА")
-        self.logger.log("Начинаем проверку графика технического обслуживания...")
-        self.logger.log(f"Получатели: {', '.join(self.config.RECIPIENTS)}")
-
-        alarm_items, warning_items, total_records, status_counts, recalc_success = self.excel_handler.read_data()
-
-        self.logger.log("\n" + "="*60)
-        self.logger.log("📈 ОБНОВЛЕНИЕ СТАТИСТИКИ ОБСЛУЖИВАНИЯ")
-        self.logger.log_separator()
-        self.statistics_manager.update_statistics(alarm_items, warning_items, total_records, status_counts)
-        self.logger.log_separator()
-
-        # === DETECTION OF SERVICED EQUIPMENT ===
+    def _detect_serviced_equipment(self):
+        """Сравнивает даты ТО с предыдущим снимком и записывает обслуженное оборудование в историю."""
         self.logger.log("\n" + "="*60)
         self.logger.log("🔍 ПОИСК ОБСЛУЖЕННОГО ОБОРУДОВАНИЯ")
         self.logger.log_separator()
@@ -1591,10 +1818,31 @@ class MaintenanceAlertApp:
         # Сохраняем текущий снимок для следующего сравнения
         self.serviced_equipment_manager.save_snapshot(current_snapshot)
         self.logger.log_separator()
-        # === END OF SERVICED DETECTION ===
 
-        total_alarm = sum(len(df) for df in alarm_items) if alarm_items else 0
-        total_warning = sum(len(df) for df in warning_items) if warning_items else 0
+    def run(self):
+        """Основная функция программы."""
+        self.show_version()
+        self.logger.log("🚀 ПРОГРАММА ЗАПУЩЕНА")
+        self.logger.log("Начинаем проверку графика технического обслуживания...")
+        self.logger.log(f"Получатели: {', '.join(self.config.RECIPIENTS)}")
+
+        alarm_items, warning_items, total_records, status_counts, recalc_success = self.excel_handler.read_data()
+
+        self.logger.log("\n" + "="*60)
+        self.logger.log("📈 ОБНОВЛЕНИЕ СТАТИСТИКИ ОБСЛУЖИВАНИЯ (в фоновом потоке)")
+        self.logger.log_separator()
+        # Запись истории (gzip JSON на сетевой папке) - ввод-вывод, он идет параллельно
+        # с поиском обслуженного оборудования. Дожидаемся её до построения письма:
+        # диаграмма в письме строится по обновленной истории.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            statistics_future = executor.submit(self.statistics_manager.update_statistics,
+                                                alarm_items, warning_items, total_records, status_counts)
+            self._detect_serviced_equipment()
+            statistics_future.result()
+
+        # Итоги уже посчитаны в read_data вместе со статусами
+        total_alarm = status_counts[self.config.STATUS_URGENT]
+        total_warning = status_counts[self.config.STATUS_WARNING]
         self.logger.log(f"\nИтого найдено:")
         self.logger.log(f"  {self.config.STATUS_URGENT}: {total_alarm}")
         self.logger.log(f"  {self.config.STATUS_WARNING}: {total_warning}")
@@ -1603,6 +1851,11 @@ class MaintenanceAlertApp:
             self.logger.log("Нет срочных напоминаний. Все оборудование в порядке.")
             return
 
+        # Без получателей письмо, диаграмму и файл вложения строить незачем
+        if not self.config.RECIPIENTS:
+            self.logger.log("⚠️ Список получателей пуст - письмо не формируется")
+            return
+
         email_body, chart_path = self.report_generator.create_body(
             alarm_items, warning_items, total_records, status_counts, recalc_success
         )
@@ -1610,7 +1863,7 @@ class MaintenanceAlertApp:
 
         # Генерируем файл maintenance_data.xlsx с данными для обслуживания
         maintenance_data_file = None
-        if alarm_items:  # Создаем файл только если есть срочные задачи
+        if not alarm_items.empty:  # Создаем файл только если есть срочные задачи
             self.logger.log("📝 Генерируем файл maintenance_data.xlsx...")
             maintenance_data_file = self.excel_handler.generate_maintenance_data_file(alarm_items)
             if maintenance_data_file:
@@ -1,7 +1,12 @@
-import json
+import atexit
+import sys
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime, date
 
+import pandas as pd
 from flask import Flask, render_template, request, redirect, url_for, send_file
 
 from maintenance_alert import (
@@ -19,13 +24,23 @@ app = Flask(__name__)
 
 # Core objects reused from maintenance_alert
 config = Config()
+# Скомпилированные шаблоны панели сохраняются на диск и переживают перезапуск сервера
+app.jinja_env.bytecode_cache = config.get_jinja_bytecode_cache("web")
 logger = DualLogger(config.LOG_FILE)
 excel_handler = ExcelHandler(config, logger)
 maintenance_checker = MaintenanceChecker(config, logger)
 statistics_manager = StatisticsManager(config, logger)
 report_generator = ReportGenerator(config, logger, maintenance_checker, statistics_manager)
-email_sender = EmailSender(config, logger)
-serviced_equipment_manager = ServicedEquipmentManager(config, logger)
+# Web-панель живет долго: SMTP-соединение переиспользуется между отправками
+email_sender = EmailSender(config, logger, keep_connection=True)
+atexit.register(email_sender.close)
+# Формирование и отправка письма выполняются в фоне, по одному письму за раз
+email_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="email")
+serviced_equipment_manager = ServicedEquipmentManager(config, logger, excel_handler)
+
+# Дата и счетчики, с которыми статистика с дашборда в последний раз успешно сохранена
+_last_stats_key = None
+_stats_update_lock = threading.Lock()
 
 
 def _format_date(date_val):
@@ -44,43 +59,85 @@ def _format_date(date_val):
     return str(date_val)
 
 
-def _build_items_list(dfs, status_label: str):
-    items = []
-    for df in dfs:
-        for _, row in df.iterrows():
-            item_type = row.get("Тип", "")
-            row_number = row.get("№", "")
-
-            # Try both possible column names where they differ between docs/Excel
-            location = row.get("Место расположения", "") or row.get("Расположение", "")
-            interval_days = row.get("Интервал ТО (дней)", "") or row.get("Интервал ТО", "")
-            
-            # Приводим к целому числу (без знака после запятой)
-            try:
-                if interval_days != "" and interval_days is not None:
-                    interval_days = int(float(interval_days))
-            except (ValueError, TypeError):
-                pass
+def _format_date_column(values):
+    """Форматирует колонку дат в dd.mm.yy целиком (для datetime64 - векторно)."""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.dt.strftime("%d.%m.%y").fillna("")
+    return values.map(_format_date)
 
-            items.append(
-                {
-                    # For filtering / actions
-                    "type": item_type,
-                    "status": status_label,  # 'urgent' or 'warning'
-                    "row_number": row_number,
-
-                    # Columns for the table
-                    "object": row.get("Объект", ""),
-                    "name": row.get("Наименование", ""),
-                    "designation": row.get("Обозначение", ""),
-                    "location": location,
-                    "works": row.get("Работы", ""),
-                    "interval_days": interval_days,
-                    "last_date": _format_date(row.get("Дата последнего ТО", "")),
-                    "next_date": _format_date(row.get("Дата следующего ТО", "")),
-                    "status_text": row.get("Статус", ""),
-                }
-            )
+
+def _update_statistics_if_changed(urgent_items, warning_items, total_records, status_counts) -> None:
+    """Обновляет статистику, если со времени последнего успешного сохранения изменились дата или счетчики.
+
+    История дневная, поэтому при повторных открытиях дашборда с теми же данными
+    перезаписывать файл истории не нужно. Неудачная запись не запоминается и
+    повторяется при следующем открытии.
+    """
+    global _last_stats_key
+    key = (date.today(), total_records, tuple(sorted(status_counts.items())))
+    with _stats_update_lock:
+        if key == _last_stats_key:
+            return
+        if statistics_manager.update_statistics(urgent_items, warning_items, total_records, status_counts):
+            _last_stats_key = key
+
+
+def _column_values(df, *names: str) -> list:
+    """Значения первой из имеющихся колонок списком; пустые строки, если нет ни одной."""
+    for name in names:
+        if name in df.columns:
+            return df[name].tolist()
+    return [""] * len(df)
+
+
+def _interval_values(values: list) -> list:
+    """Приводит интервалы ТО к целым числам (без знака после запятой); нечисловые значения не меняются."""
+    numeric = pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").tolist()
+    return [value if pd.isna(number) else int(number) for value, number in zip(values, numeric)]
+
+
+def _build_items_list(df, status_label: str):
+    items = []
+    date_columns = [col for col in ("Дата последнего ТО", "Дата следующего ТО") if col in df.columns]
+    if date_columns:
+        df = df.assign(**{col: _format_date_column(df[col]) for col in date_columns})
+    # Колонки извлекаются списками один раз на весь DataFrame, строки собираются через zip -
+    # без Series и промежуточного словаря на каждую строку
+    rows = zip(
+        _column_values(df, "Тип"),
+        _column_values(df, "№"),
+        _column_values(df, "Объект"),
+        _column_values(df, "Наименование"),
+        _column_values(df, "Обозначение"),
+        # Column names differ between docs/Excel: the name is chosen once per DataFrame
+        _column_values(df, "Место расположения", "Расположение"),
+        _column_values(df, "Работы"),
+        _interval_values(_column_values(df, "Интервал ТО (дней)", "Интервал ТО")),
+        _column_values(df, "Дата последнего ТО"),
+        _column_values(df, "Дата следующего ТО"),
+        _column_values(df, "Статус"),
+    )
+    for (item_type, row_number, object_name, name, designation, location, works,
+         interval_days, last_date, next_date, status_text) in rows:
+        items.append(
+            {
+                # For filtering / actions
+                "type": item_type,
+                "status": status_label,  # 'urgent' or 'warning'
+                "row_number": row_number,
+
+                # Columns for the table
+                "object": object_name,
+                "name": name,
+                "designation": designation,
+                "location": location,
+                "works": works,
+                "interval_days": interval_days,
+                "last_date": last_date,
+                "next_date": next_date,
+                "status_text": status_text,
+            }
+        )
     return items
 
 
@@ -99,7 +156,7 @@ def dashboard():
     chart_offset = 0
     if chart_date:
         try:
-            selected_date = datetime.strptime(chart_date, "%Y-%m-%d").date()
+            selected_date = date.fromisoformat(chart_date)
             today = datetime.now().date()
             chart_offset = (selected_date - today).days
         except ValueError:
@@ -112,8 +169,8 @@ def dashboard():
 
     urgent_items, warning_items, total_records, status_counts, recalc_success = excel_handler.read_data()
 
-    # Update statistics automatically on dashboard load
-    statistics_manager.update_statistics(urgent_items, warning_items, total_records, status_counts)
+    # Update statistics automatically on dashboard load (once per day or data change)
+    _update_statistics_if_changed(urgent_items, warning_items, total_records, status_counts)
 
     urgent_list = _build_items_list(urgent_items, "urgent")
     warning_list = _build_items_list(warning_items, "warning")
@@ -122,28 +179,30 @@ def dashboard():
     urgent_list.sort(key=lambda x: str(x.get("object", "")))
     warning_list.sort(key=lambda x: str(x.get("object", "")))
 
-    # Collect unique objects for dropdown
-    all_items = urgent_list + warning_list
-    unique_objects = sorted(set(item.get("object", "") for item in all_items if item.get("object")))
+    # Collect unique objects for dropdown (уникальные значения колонки, без обхода словарей строк)
+    objects = pd.concat([urgent_items["Объект"], warning_items["Объект"]], ignore_index=True)
+    unique_objects = sorted(objects[objects.notna() & (objects != "")].unique())
 
-    def apply_filters(items):
+    def count_filtered(df):
+        """Число строк, проходящих фильтры панели (маски по колонкам DataFrame, без цикла по строкам)."""
+        mask = pd.Series(True, index=df.index)
         if sheet_type != "all":
-            items = [i for i in items if i["type"] == sheet_type]
+            mask &= df["Тип"] == sheet_type
         if designation_filter:
             # Filter by designation - case insensitive substring match
-            items = [i for i in items if designation_filter.lower() in str(i.get("designation", "")).lower()]
+            mask &= df["Обозначение"].astype(str).str.contains(designation_filter, case=False, regex=False, na=False)
         if object_filter != "all":
-            items = [i for i in items if i.get("object") == object_filter]
-        return items
+            mask &= df["Объект"] == object_filter
+        return int(mask.sum())
 
     show_urgent = status_filter in ("all", "urgent")
     show_warning = status_filter in ("all", "warning")
 
-    filtered_urgent = apply_filters(urgent_list) if show_urgent else []
-    filtered_warning = apply_filters(warning_list) if show_warning else []
+    filtered_urgent_count = count_filtered(urgent_items) if show_urgent else 0
+    filtered_warning_count = count_filtered(warning_items) if show_warning else 0
 
     # Reset filters if no records match after a servicing action
-    if serviced_status and not filtered_urgent and not filtered_warning:
+    if serviced_status and not filtered_urgent_count and not filtered_warning_count:
         has_active_filters = (sheet_type != "all" or status_filter != "all" or 
                              designation_filter != "" or object_filter != "all")
         if has_active_filters:
@@ -151,8 +210,6 @@ def dashboard():
                                    serviced_status=serviced_status,
                                    serviced_message=serviced_message))
 
-    filtered_urgent_count = len(filtered_urgent)
-    filtered_warning_count = len(filtered_warning)
     total_urgent = len(urgent_list)
     total_warning = len(warning_list)
 
@@ -217,7 +274,7 @@ def stats():
     chart_offset = 0
     if chart_date:
         try:
-            selected_date = datetime.strptime(chart_date, "%Y-%m-%d").date()
+            selected_date = date.fromisoformat(chart_date)
             today = datetime.now().date()
             chart_offset = (selected_date - today).days
         except ValueError:
@@ -266,40 +323,52 @@ def chart_png():
     return send_file(chart_path, mimetype="image/png")
 
 
+def _send_report(urgent_items, warning_items, total_records, status_counts, recalc_success) -> bool:
+    """Формирует и отправляет письмо-отчет (выполняется в email_executor)."""
+    try:
+        email_body, chart_path = report_generator.create_body(
+            urgent_items,
+            warning_items,
+            total_records,
+            status_counts,
+            recalc_success,
+        )
+
+        maintenance_data_file = None
+        if not urgent_items.empty:
+            maintenance_data_file = excel_handler.generate_maintenance_data_file(urgent_items)
+
+        sent = email_sender.send(email_body, config.RECIPIENTS, chart_path, maintenance_data_file)
+
+        if sent and maintenance_data_file and maintenance_data_file.exists():
+            try:
+                maintenance_data_file.unlink()
+            except Exception:
+                pass
+        return sent
+    except Exception as e:
+        # Исключение фоновой задачи иначе осталось бы незамеченным в Future
+        logger.log(f"❌ Ошибка при формировании или отправке письма: {e}")
+        return False
+
+
 @app.route("/send-email", methods=["POST"])
 def send_email():
     urgent_items, warning_items, total_records, status_counts, recalc_success = excel_handler.read_data()
 
-    total_alarm = sum(len(df) for df in urgent_items) if urgent_items else 0
-    total_warning = sum(len(df) for df in warning_items) if warning_items else 0
+    total_alarm = status_counts[config.STATUS_URGENT]
+    total_warning = status_counts[config.STATUS_WARNING]
 
     if total_alarm == 0 and total_warning == 0:
         return redirect(url_for("dashboard", email_status="no_items"))
 
     statistics_manager.update_statistics(urgent_items, warning_items, total_records, status_counts)
 
-    email_body, chart_path = report_generator.create_body(
-        urgent_items,
-        warning_items,
-        total_records,
-        status_counts,
-        recalc_success,
-    )
+    if not config.RECIPIENTS:
+        return redirect(url_for("dashboard", email_status="no_recipients"))
 
-    maintenance_data_file = None
-    if urgent_items:
-        maintenance_data_file = excel_handler.generate_maintenance_data_file(urgent_items)
-
-    sent = email_sender.send(email_body, config.RECIPIENTS, chart_path, maintenance_data_file)
-
-    if sent and maintenance_data_file and maintenance_data_file.exists():
-        try:
-            maintenance_data_file.unlink()
-        except Exception:
-            pass
-
-    status = "sent" if sent else "error"
-    return redirect(url_for("dashboard", email_status=status))
+    email_executor.submit(_send_report, urgent_items, warning_items, total_records, status_counts, recalc_success)
+    return redirect(url_for("dashboard", email_status="queued"))
 
 
 @app.route("/download-excel")
@@ -322,7 +391,7 @@ def download_excel_tmp():
     # Получаем актуальные данные о срочном обслуживании
     urgent_items, _, _, _, _ = excel_handler.read_data()
     
-    if not urgent_items:
+    if urgent_items.empty:
         return ("Нет оборудования, требующего срочного обслуживания (список пуст).", 404)
         
     # Генерируем файл на основе шаблона
@@ -386,23 +455,13 @@ def mark_serviced():
 def mark_bulk_serviced():
     """
     Отмечает несколько единиц оборудования как обслуженное.
-    Принимает JSON-массив items с объектами {sheet_name, designation}
+    Принимает повторяющееся поле формы item со значениями вида "<лист>|<номер>"
     """
-    items_json = request.form.get("items", "[]")
+    items = request.form.getlist("item")
     object_filter = request.form.get("object", "all")
     status_filter = request.form.get("status", "all")
     designation_filter = request.form.get("designation_filter", "")
     
-    try:
-        items = json.loads(items_json)
-    except json.JSONDecodeError:
-        return redirect(url_for("dashboard",
-                               object=object_filter,
-                               status=status_filter,
-                               designation=designation_filter,
-                               serviced_status="error",
-                               serviced_message="Ошибка обработки данных"))
-    
     if not items:
         return redirect(url_for("dashboard",
                                object=object_filter,
@@ -428,17 +487,23 @@ def mark_bulk_serviced():
     errors = []
     serviced_items = []  # успешно обслуженные (sheet_name, row_number) для журнала
     
+    # Группируем позиции по листам: книга открывается и сохраняется один раз на всю операцию
+    items_by_sheet = defaultdict(list)
     for item in items:
-        sheet_name = item.get("sheet_name", "").strip()
-        row_number = item.get("row_number", "").strip()
+        # Номер строки - после последнего разделителя, название листа - все до него
+        sheet_name, _, row_number = item.rpartition("|")
+        sheet_name = sheet_name.strip()
+        row_number = row_number.strip()
         
         if not sheet_name or not row_number:
             error_count += 1
             errors.append(f"Пропущено: неполные данные")
             continue
         
-        success, message = excel_handler.mark_as_serviced(sheet_name, row_number, make_backup=False)
-        
+        items_by_sheet[sheet_name].append(row_number)
+    
+    results = excel_handler.mark_many_as_serviced(items_by_sheet, make_backup=False) if items_by_sheet else []
+    for sheet_name, row_number, success, message in results:
         if success:
             success_count += 1
             serviced_items.append((sheet_name, row_number))
@@ -472,7 +537,22 @@ def mark_bulk_serviced():
                            serviced_message=result_message))
 
 
+def _serve_production(host: str, port: int) -> bool:
+    """Запускает панель под WSGI-сервером waitress; False, если waitress не установлен."""
+    try:
+        from waitress import serve
+    except ImportError:
+        logger.log("⚠️ waitress недоступен, запускается встроенный сервер Flask")
+        logger.log("💡 Установите: pip install waitress")
+        return False
+    logger.log(f"🌐 Панель запущена под waitress: http://{host}:{port}/")
+    serve(app, host=host, port=port, threads=8)
+    return True
+
+
 if __name__ == "__main__":
     # Разрешаем доступ из сети (0.0.0.0 слушает все интерфейсы)
     # Приложение будет доступно по IP сервера в сети 10.100.56.x
-    app.run(host='0.0.0.0', port=5940, debug=False)
+    # С флагом --prod панель обслуживает waitress (пул потоков) вместо сервера разработки Werkzeug
+    if "--prod" not in sys.argv[1:] or not _serve_production('0.0.0.0', 5940):
+        app.run(host='0.0.0.0', port=5940, debug=False)